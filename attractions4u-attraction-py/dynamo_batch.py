@@ -0,0 +1,84 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# DynamoDB batchGet limit is 100
+BATCH_GET_LIMIT = 100
+BATCH_GET_MAX_RETRIES = 8
+BATCH_GET_BASE_DELAY = 0.05
+BATCH_GET_MAX_DELAY = 2.0
+
+
+def thread_safe_client(dynamo):
+    # Client for calls made from worker threads. boto3 resources and their Table objects must not be shared
+    # between threads, their low-level client can. The resource's client still converts Python values.
+    return dynamo.meta.client
+
+
+def key_id(key: dict):
+    return tuple(sorted(key.items()))
+
+
+def batch_get_chunk(dynamo, table_name, keys, projection=None, attr_names=None):
+    request = {'Keys': keys}
+    if projection:
+        request['ProjectionExpression'] = projection
+    if attr_names:
+        request['ExpressionAttributeNames'] = attr_names
+
+    items = []
+    request_items = {table_name: request}
+    for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+        response = thread_safe_client(dynamo).batch_get_item(RequestItems=request_items)
+        items.extend(response['Responses'].get(table_name, []))
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            return items
+        if attempt < BATCH_GET_MAX_RETRIES:
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, min(BATCH_GET_MAX_DELAY, BATCH_GET_BASE_DELAY * 2 ** attempt)))
+
+    left = len(request_items[table_name]['Keys'])
+    print(f'[WARN] batch_get_item gave up on {left} unprocessed keys of {table_name}')
+    return items
+
+
+def batch_get_items(dynamo, table_name, keys: list, projection=None, attr_names=None, max_workers=8):
+    # Fetches any number of items, returned in the order of the given keys.
+    # Missing items are left out, duplicate keys are fetched once.
+    unique_keys = list({key_id(k): k for k in keys}.values())
+    if not len(unique_keys):
+        return []
+
+    # The projection must include the key attributes to map items back to their keys
+    key_names = list(unique_keys[0].keys())
+    if projection:
+        projected = [p.strip() for p in projection.split(',')]
+        aliased = set((attr_names or {}).values())
+        for name in key_names:
+            if name not in projected and name not in aliased:
+                projected.append(name)
+        projection = ', '.join(projected)
+
+    chunks = [unique_keys[i:i + BATCH_GET_LIMIT] for i in range(0, len(unique_keys), BATCH_GET_LIMIT)]
+
+    def get_chunk(chunk):
+        return batch_get_chunk(dynamo, table_name, chunk, projection, attr_names)
+
+    if len(chunks) == 1:
+        results = [get_chunk(chunks[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+            results = list(pool.map(get_chunk, chunks))
+
+    by_key = {}
+    for chunk_items in results:
+        for item in chunk_items:
+            by_key[key_id({name: item[name] for name in key_names})] = item
+    res = []
+    for k in unique_keys:
+        item = by_key.get(key_id(k))
+        if item is not None:
+            res.append(item)
+    return res
@@ -1,28 +1,77 @@
+import time
+MODULE_START = time.perf_counter()
+
 import boto3
+from concurrent.futures import ThreadPoolExecutor, wait
 from decimal import Decimal
-from elasticsearch import Elasticsearch
-import inflect
+from dynamo_batch import batch_get_items, thread_safe_client
 import json
-import nltk
+from lazy_init import Lazy, record_timing, reports_init, warm_up
+from local_cache import LRUCache
 import os
-import string
-import time
+from restaurant_cache import RestaurantCache, to_dynamo
+from text_norm import proc_usr_query
 from urllib.parse import quote
 import urllib3
+from visits import VisitBuffer, increment_attraction_cnt, record_history_visit
 
+record_timing('imports', MODULE_START)
 
-client = Elasticsearch(
-    os.environ['ES'],
-    http_auth=(os.environ['ES_U'], os.environ['ES_K']),
-    max_retries=5,
-    request_timeout=60000
-)
-dynamo = boto3.resource('dynamodb')
 
-attractionTable = dynamo.Table("attractions4u-attractions")
-pageHistoryTable = dynamo.Table("attractions4u-page-history")
+def create_es_client():
+    from elasticsearch import Elasticsearch
+    return Elasticsearch(
+        os.environ['ES'],
+        http_auth=(os.environ['ES_U'], os.environ['ES_K']),
+        max_retries=5,
+        request_timeout=60000
+    )
+
+
+# Created on first use, e.g. the detail route never needs Elasticsearch
+client = Lazy('elasticsearch', create_es_client)
+dynamo = Lazy('dynamodb', lambda: boto3.resource('dynamodb'))
+
+ATTRACTION_TABLE_NAME = "attractions4u-attractions"
+PAGE_HISTORY_TABLE_NAME = "attractions4u-page-history"
+attractionTable = Lazy('attractionTable', lambda: dynamo.Table(ATTRACTION_TABLE_NAME))
 # searchHistoryTable = dynamo.Table("attractions4u-search-history")
 
+# Hot attractions are kept in the warm container to save DynamoDB reads
+item_cache = LRUCache(
+    'attraction',
+    int(os.environ.get('ITEM_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+    float(os.environ.get('ITEM_CACHE_TTL', 60))
+)
+search_row_cache = LRUCache(
+    'search-row',
+    int(os.environ.get('SEARCH_ROW_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+    float(os.environ.get('SEARCH_ROW_CACHE_TTL', 300))
+)
+SEARCH_ROW_PROJECTION = "attractionId, attractionName, description, photos, rating, reviews_cnt"
+
+# Max time (ms) the detail route waits for its side work before responding without it
+DETAIL_DEADLINE_MS = int(os.environ.get('DETAIL_DEADLINE_MS', 1500))
+# DynamoDB writes and the external lookups (Yelp) run on separate pools, so slow lookups can't hold up the writes
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('DETAIL_WORKERS', 4)))
+lookup_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LOOKUP_WORKERS', 4)))
+
+# Seconds that page views may be buffered before their counters are written, 0 writes them synchronously
+VISIT_BUFFER_MAX_AGE = float(os.environ.get('VISIT_BUFFER_MAX_AGE', 0))
+visit_buffer = None
+if VISIT_BUFFER_MAX_AGE > 0:
+    visit_buffer = VisitBuffer(
+        dynamo,
+        ATTRACTION_TABLE_NAME,
+        PAGE_HISTORY_TABLE_NAME,
+        VISIT_BUFFER_MAX_AGE,
+        int(os.environ.get('VISIT_BUFFER_MAX_SIZE', 200)),
+        int(os.environ.get('VISIT_BUFFER_MAX_PENDING', 1000))
+    )
+# Buffered visits are flushed one batch at a time on their own thread, off the response path
+flush_executor = ThreadPoolExecutor(max_workers=1)
+flush_future = None
+
 
 response_headers = {
     "Content-Type": "application/json",
@@ -61,9 +110,22 @@ example = {
 }
 
 
+# Yelp results are shared by attractions in the same area
+restaurant_cache = RestaurantCache(
+    float(os.environ.get('RESTAURANT_CACHE_TTL', 7 * 24 * 3600)),
+    float(os.environ.get('RESTAURANT_CACHE_NEGATIVE_TTL', 3600)),
+    int(os.environ.get('RESTAURANT_CACHE_MAX_BYTES', 4 * 1024 * 1024)),
+    dynamo,
+    os.environ.get('RESTAURANT_CACHE_TABLE')
+)
+# Whether to persist looked up restaurants onto the attraction items that have none
+RESTAURANT_BACKFILL = os.environ.get('RESTAURANT_BACKFILL', '0') == '1'
+
+
 yelp_headers = urllib3.make_headers()
 yelp_headers['Authorization'] = f"Bearer {os.environ['YELP_K']}"
-http = urllib3.PoolManager()
+# A lookup that outlives the detail deadline is dropped anyway, don't let it hold a worker longer
+http = urllib3.PoolManager(timeout=urllib3.Timeout(total=DETAIL_DEADLINE_MS / 1000))
 
 
 def get_request(host, path, url_params):
@@ -80,12 +142,21 @@ def search_restaurants(term, location):
         'limit': int(SEARCH_LIMIT),
         'radius': int(40000)
     }
-    res = get_request(YELP_HOST, YELP_PATH, url_params).get('businesses', [])
+    res = get_request(YELP_HOST, YELP_PATH, url_params)
+    if 'error' in res:
+        print('[WARN] Yelp error', res['error'])
+        return None
+    res = res.get('businesses', [])
     for i in range(len(res)):
         res[i] = {k: v for k, v in res[i].items() if k in example}
     return res
 
 
+def get_restaurants(address: str):
+    location = get_location_query(address)
+    return restaurant_cache.get_or_fetch(location, lambda: search_restaurants(YELP_SEARCH_TERM, location))
+
+
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Decimal):
@@ -110,24 +181,175 @@ def get_location_query(addr: str):
     return res
 
 
-NOUN_TAGS = {'NN', 'NNS', 'NNPS', 'NNP'}
-INFLECT = inflect.engine()
+def invalidate_attraction(attraction_id):
+    # Must be called after any write to an attraction item
+    item_cache.invalidate(attraction_id)
+    search_row_cache.invalidate(attraction_id)
 
-def proc_usr_query(query_str: str):
-    res_tokens = []
-    for token, tag in nltk.pos_tag(query_str.replace('_', ' ').translate(str.maketrans('', '', string.punctuation)).split()):
-        if tag in NOUN_TAGS:
-            singular = INFLECT.singular_noun(token)
-            if singular:
-                res_tokens.append(singular)
-            else:
-                res_tokens.append(token)
+
+def get_search_rows(ids: list):
+    rows = {}
+    missing = []
+    for key in ids:
+        row = search_row_cache.get(key['attractionId'])
+        if row is None:
+            missing.append(key)
+        else:
+            rows[key['attractionId']] = row
+    if len(missing):
+        for row in batch_get_items(dynamo, ATTRACTION_TABLE_NAME, missing, projection=SEARCH_ROW_PROJECTION):
+            search_row_cache.put(row['attractionId'], row)
+            rows[row['attractionId']] = row
+    return [rows[key['attractionId']] for key in ids if key['attractionId'] in rows]
+
+
+def submit_timed(pool, timings: dict, name, func, *args):
+    def run():
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings[name] = (time.perf_counter() - start) * 1000
+    return pool.submit(run)
+
+
+def result_or_default(timings: dict, futures: dict, name, default=None):
+    future = futures.get(name)
+    if future is None:
+        return default
+    if not future.done():
+        # Keeps running in the background, its result is dropped
+        timings[name] = 'timeout'
+        return default
+    try:
+        return future.result()
+    except Exception as e:
+        print(f'[WARN] {name} failed', e)
+        return default
+
+
+def attach_restaurants(attractionId, address: str):
+    restaurants = get_restaurants(address)
+    if RESTAURANT_BACKFILL and len(restaurants):
+        # Runs in the thread pool
+        thread_safe_client(dynamo).update_item(
+            TableName=ATTRACTION_TABLE_NAME,
+            Key={'attractionId': attractionId},
+            UpdateExpression='SET restaurants = :r',
+            ExpressionAttributeValues={':r': to_dynamo(restaurants)}
+        )
+        invalidate_attraction(attractionId)
+    return restaurants
+
+
+def get_attraction_detail(attractionId, username, t):
+    # Only the item itself is needed to build the response. The counters, the page view history
+    # and the restaurant lookup run in the thread pool and are waited for until DETAIL_DEADLINE_MS.
+    timings = {}
+    futures = {}
+    body = item_cache.get(attractionId)
+    cached = body is not None
+    if cached and 'restaurants' not in body:
+        futures['yelp'] = submit_timed(
+            lookup_executor, timings, 'yelp', attach_restaurants, attractionId, body['address'])
+
+    if visit_buffer is None:
+        if cached:
+            futures['counter'] = submit_timed(
+                executor, timings, 'counter', increment_attraction_cnt, dynamo, ATTRACTION_TABLE_NAME, attractionId)
         else:
-            res_tokens.append(token)
-    return ' '.join(res_tokens)
+            # Fetch the item and bump its counter in one round trip
+            start = time.perf_counter()
+            body = increment_attraction_cnt(dynamo, ATTRACTION_TABLE_NAME, attractionId, return_item=True)
+            timings['fetch'] = (time.perf_counter() - start) * 1000
+        if body is not None:
+            futures['history'] = submit_timed(
+                executor, timings, 'history', record_history_visit,
+                dynamo, PAGE_HISTORY_TABLE_NAME, username, attractionId, t)
+    else:
+        if not cached:
+            start = time.perf_counter()
+            body = attractionTable.get_item(Key={'attractionId': attractionId}).get('Item')
+            timings['fetch'] = (time.perf_counter() - start) * 1000
+            if body is not None:
+                item_cache.put(attractionId, body)
+        if body is not None:
+            visit_buffer.add(username, attractionId, t)
+            body['cnt'] = body.get('cnt', 0) + visit_buffer.pending_cnt(attractionId)
+
+    if body is not None and 'restaurants' not in body and 'yelp' not in futures:
+        futures['yelp'] = submit_timed(
+            lookup_executor, timings, 'yelp', attach_restaurants, attractionId, body['address'])
+
+    wait(futures.values(), timeout=DETAIL_DEADLINE_MS / 1000)
+
+    if 'counter' in futures:
+        cnt = result_or_default(timings, futures, 'counter', body.get('cnt', 0) + 1)
+        if cnt is None:
+            # Deleted since it was cached
+            body = None
+        else:
+            body['cnt'] = cnt
+    result_or_default(timings, futures, 'history')
+    restaurants = result_or_default(timings, futures, 'yelp', [])
+
+    print('[INFO] detail {}'.format(' '.join(
+        f'{k}={v:.1f}ms' if isinstance(v, float) else f'{k}={v}' for k, v in timings.items())))
+
+    if body is None:
+        invalidate_attraction(attractionId)
+        return None
+    if 'restaurants' not in body and RESTAURANT_BACKFILL and len(restaurants):
+        # Persisted onto the item by attach_restaurants
+        body['restaurants'] = restaurants
+    if visit_buffer is None and (not cached or futures['counter'].done()):
+        item_cache.put(attractionId, body)
+
+    # Fill missing data
+    if 'weekday_text' not in body['opening_hours']:
+        body['opening_hours']['weekday_text'] = []
+    if 'restaurants' not in body:
+        body['restaurants'] = restaurants
+    return body
+
+
+def flush_visits():
+    for attraction_id in visit_buffer.flush():
+        invalidate_attraction(attraction_id)
+
+
+def schedule_flush():
+    global flush_future
+    if flush_future is None or flush_future.done():
+        # If the container is frozen before it is done, it finishes in the next invocation
+        flush_future = flush_executor.submit(flush_visits)
+    elif visit_buffer.is_full():
+        # The previous flush is stuck, write the buffer here rather than let it grow until the container is reclaimed
+        print('[WARN] Flushing visits synchronously, the background flush is still running')
+        flush_visits()
+
+
+@reports_init
+def lambda_handler(event, context):
+    if event.get('warmup'):
+        # Scheduled ping, initialize everything (or the listed dependencies) without serving a request
+        names = event['warmup'] if isinstance(event['warmup'], list) else None
+        return {
+            'statusCode': 200,
+            'body': json.dumps(warm_up(names)),
+            'headers': response_headers
+        }
 
+    res = handle_request(event)
+    if visit_buffer is not None and visit_buffer.is_due():
+        schedule_flush()
+    print(item_cache.pop_stats())
+    print(search_row_cache.pop_stats())
+    print(restaurant_cache.local.pop_stats())
+    return res
 
-def lambda_handler(event, context):
+
+def handle_request(event):
     username = event['requestContext']['authorizer']['jwt']['claims']['email']
     body = ''
     t = time.time_ns()
@@ -185,59 +407,15 @@ def lambda_handler(event, context):
             # searchHistoryTable.put_item(Item=historyRow)
 
             # Get attraction details given IDs
-            batch_q = {
-                attractionTable.name: {
-                    'Keys': ids,
-                    'ProjectionExpression': "attractionId, attractionName, description, photos, rating, reviews_cnt"
-                }
-            }
-            tmp = dynamo.batch_get_item(RequestItems=batch_q)
-            body = tmp['Responses'][attractionTable.name]
+            body = get_search_rows(ids)
 
         else:
             body = []
 
     elif path == "GET /attraction/{attractionId}":
         attractionId = event['pathParameters']['attractionId']
-        tmp = attractionTable.get_item(Key={'attractionId': attractionId})
-
-        if 'Item' in tmp:
-            body = tmp['Item']
-
-            # Update page visit count and missing data
-            if 'cnt' in body:
-                body['cnt'] += 1
-            else:
-                body['cnt'] = 1
-
-            if 'weekday_text' not in body['opening_hours']:
-                body['opening_hours']['weekday_text'] = []
-
-            attractionTable.put_item(Item=body)
-
-            # Update page view history
-            historyRes = pageHistoryTable.get_item(
-                Key={
-                    "attractionId": attractionId, 
-                    "username": username
-                }
-            )
-            if 'Item' in historyRes:
-                historyRow = historyRes['Item']
-                historyRow['cnt'] += 1
-                historyRow['lastVisit'] = t
-            else:
-                historyRow = {
-                    "attractionId": attractionId, 
-                    "username": username,
-                    "cnt": 1,
-                    "lastVisit": t
-                }
-            pageHistoryTable.put_item(Item=historyRow)
-
-            if 'restaurants' not in body:
-                body['restaurants'] = search_restaurants(YELP_SEARCH_TERM, get_location_query(body['address']))
-        else:
+        body = get_attraction_detail(attractionId, username, t)
+        if body is None:
             return {
                 "statusCode": 404,
                 'body': json.dumps({"err": f'Attraction with ID {attractionId} doesn\'t exist!'}),
@@ -255,3 +433,6 @@ def lambda_handler(event, context):
         'body': json.dumps(body, cls=DecimalEncoder),
         'headers': response_headers
     }
+
+
+record_timing('module', MODULE_START)
@@ -0,0 +1,76 @@
+import functools
+import threading
+import time
+
+
+# name -> ms spent creating it, in the order things got initialized
+INIT_TIMINGS = {}
+REGISTRY = []
+# Names already logged by reports_init
+REPORTED = set()
+
+
+class Lazy:
+    # Creates a heavy dependency on first use and then behaves like it.
+    # Attribute access is forwarded, so module globals can be declared as before.
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._value = None
+        self._ready = False
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def instance(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    start = time.perf_counter()
+                    self._value = self._factory()
+                    INIT_TIMINGS[self._name] = (time.perf_counter() - start) * 1000
+                    self._ready = True
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self.instance(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.instance()(*args, **kwargs)
+
+
+def record_timing(name, start):
+    INIT_TIMINGS[name] = (time.perf_counter() - start) * 1000
+
+
+def warm_up(names=None):
+    # Initializes every registered dependency (or only the given ones), meant for scheduled pings
+    for dep in REGISTRY:
+        if names is None or dep._name in names:
+            dep.instance()
+    return init_report()
+
+
+def init_report():
+    return {name: round(ms, 1) for name, ms in INIT_TIMINGS.items()}
+
+
+def pop_init_report():
+    # Timings recorded since the last call
+    new = {name: round(ms, 1) for name, ms in INIT_TIMINGS.items() if name not in REPORTED}
+    REPORTED.update(new)
+    return new
+
+
+def reports_init(handler):
+    # Logs what got initialized while handling an invocation: imports, module and the dependencies
+    # the first request created on a cold start, later dependencies when something first uses them
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            report = pop_init_report()
+            if len(report):
+                print('[INIT]', report)
+    return wrapper
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import copy
+import json
+import threading
+import time
+
+
+class LRUCache:
+    # TTL + LRU cache bounded by the approximate serialized size of its values.
+    # Lives in module globals so it survives across invocations of a warm container.
+
+    def __init__(self, name, max_bytes, ttl, sizeof=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda v: len(json.dumps(v, default=str)))
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Background work of the detail route may still be running when the next invocation starts
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, _, value = entry
+            if expires_at < time.monotonic():
+                self.invalidate(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            # Callers mutate the items they get back, hand out copies
+            return copy.deepcopy(value)
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            size = self.sizeof(value)
+            self.invalidate(key)
+            if size > self.max_bytes:
+                return
+            ttl = self.ttl if ttl is None else ttl
+            self.entries[key] = (time.monotonic() + ttl, size, copy.deepcopy(value))
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def pop_stats(self):
+        # Counters since the last call, meant to be logged once per invocation
+        with self.lock:
+            stats = f'[CACHE] {self.name} hits={self.hits} misses={self.misses} ' \
+                    f'entries={len(self.entries)} bytes={self.total_bytes}'
+            self.hits = 0
+            self.misses = 0
+            return stats
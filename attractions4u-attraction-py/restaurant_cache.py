@@ -0,0 +1,60 @@
+from decimal import Decimal
+import json
+import re
+import time
+
+from dynamo_batch import thread_safe_client
+from local_cache import LRUCache
+
+
+def normalize_location(location_query: str):
+    return re.sub(r'[\s+]+', '+', location_query.strip().lower()).strip('+')
+
+
+def to_dynamo(value):
+    # DynamoDB doesn't accept floats
+    return json.loads(json.dumps(value), parse_float=Decimal)
+
+
+class RestaurantCache:
+    # Yelp lookups keyed by normalized location, kept in the warm container and optionally in
+    # a DynamoDB table (partition key "location", TTL attribute "expiresAt") shared by all containers.
+    # Empty results are cached as well, for a shorter time.
+
+    def __init__(self, ttl, negative_ttl, max_bytes, dynamo=None, table_name=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = LRUCache('restaurant', max_bytes, ttl)
+        self.dynamo = dynamo
+        self.table_name = table_name
+
+    def get_or_fetch(self, location_query: str, fetch):
+        key = normalize_location(location_query)
+        restaurants = self.local.get(key)
+        if restaurants is not None:
+            return restaurants
+
+        # Called from the thread pool
+        if self.table_name:
+            item = thread_safe_client(self.dynamo).get_item(
+                TableName=self.table_name,
+                Key={'location': key}
+            ).get('Item')
+            if item is not None and item['expiresAt'] > time.time():
+                restaurants = item['restaurants']
+                self.local.put(key, restaurants, self.ttl if len(restaurants) else self.negative_ttl)
+                return restaurants
+
+        restaurants = fetch()
+        if restaurants is None:
+            # Yelp error, don't cache it
+            return []
+        ttl = self.ttl if len(restaurants) else self.negative_ttl
+        self.local.put(key, restaurants, ttl)
+        if self.table_name:
+            thread_safe_client(self.dynamo).put_item(TableName=self.table_name, Item={
+                'location': key,
+                'restaurants': to_dynamo(restaurants),
+                'expiresAt': int(time.time() + ttl)
+            })
+        return restaurants
@@ -0,0 +1,126 @@
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from dynamo_batch import thread_safe_client
+import threading
+import time
+
+
+def increment_attraction_cnt(dynamo, table_name, attraction_id, n=1, return_item=False):
+    # Atomic counter update, returns the updated item (or only its cnt), or None if it doesn't exist
+    try:
+        res = thread_safe_client(dynamo).update_item(
+            TableName=table_name,
+            Key={'attractionId': attraction_id},
+            UpdateExpression='ADD cnt :n',
+            ConditionExpression='attribute_exists(attractionId)',
+            ExpressionAttributeValues={':n': n},
+            ReturnValues='ALL_NEW' if return_item else 'UPDATED_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return res['Attributes'] if return_item else res['Attributes']['cnt']
+
+
+def record_history_visit(dynamo, table_name, username, attraction_id, t, n=1):
+    # Creates the history row on the first visit
+    thread_safe_client(dynamo).update_item(
+        TableName=table_name,
+        Key={'attractionId': attraction_id, 'username': username},
+        UpdateExpression='ADD cnt :n SET lastVisit = :t',
+        ExpressionAttributeValues={':n': n, ':t': t}
+    )
+
+
+class VisitBuffer:
+    # Write-behind buffer that coalesces page views per (user, attraction) and flushes
+    # them as counter updates once the oldest pending view is older than max_age seconds
+    # or max_size pairs are pending. Updates that fail are put back and retried with the
+    # next flush. Views still buffered when the container is reclaimed are lost, so keep
+    # max_age small. Flushes may overlap, each writes the updates it took out of the buffer.
+
+    def __init__(self, dynamo, attraction_table_name, history_table_name, max_age, max_size=200,
+                 max_pending=1000, max_workers=8):
+        self.dynamo = dynamo
+        self.attraction_table_name = attraction_table_name
+        self.history_table_name = history_table_name
+        self.max_age = max_age
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.pending = {}  # (username, attractionId) -> [cnt, lastVisit], history rows to write
+        self.pending_cnts = {}  # attractionId -> cnt, counters to add
+        self.oldest = None
+
+    def add(self, username, attraction_id, t):
+        with self.lock:
+            entry = self.pending.setdefault((username, attraction_id), [0, t])
+            entry[0] += 1
+            entry[1] = max(entry[1], t)
+            self.pending_cnts[attraction_id] = self.pending_cnts.get(attraction_id, 0) + 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+    def requeue(self, history, cnts):
+        # Merges the updates of a failed flush back into the buffer
+        with self.lock:
+            for key, (cnt, t) in history.items():
+                entry = self.pending.setdefault(key, [0, t])
+                entry[0] += cnt
+                entry[1] = max(entry[1], t)
+            for aid, cnt in cnts.items():
+                self.pending_cnts[aid] = self.pending_cnts.get(aid, 0) + cnt
+            if (len(history) or len(cnts)) and self.oldest is None:
+                self.oldest = time.monotonic()
+
+    def pending_cnt(self, attraction_id):
+        with self.lock:
+            return self.pending_cnts.get(attraction_id, 0)
+
+    def is_due(self):
+        with self.lock:
+            return self.oldest is not None and (
+                len(self.pending) + len(self.pending_cnts) >= self.max_size
+                or time.monotonic() - self.oldest >= self.max_age)
+
+    def is_full(self):
+        # Too much pending to wait for a background flush any longer
+        with self.lock:
+            return len(self.pending) + len(self.pending_cnts) >= self.max_pending
+
+    def flush(self):
+        # Returns the IDs of the attractions whose counters were updated
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            attraction_cnts, self.pending_cnts = self.pending_cnts, {}
+            self.oldest = None
+        return self.write(pending, attraction_cnts)
+
+    def write(self, pending, attraction_cnts):
+        if not len(pending) and not len(attraction_cnts):
+            return []
+
+        def update_attraction(args):
+            increment_attraction_cnt(self.dynamo, self.attraction_table_name, *args)
+
+        def update_history(args):
+            (username, aid), (cnt, t) = args
+            record_history_visit(self.dynamo, self.history_table_name, username, aid, t, cnt)
+
+        failed_history, failed_cnts = {}, {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(pool.submit(update_attraction, args), failed_cnts, args) for args in attraction_cnts.items()]
+            futures += [(pool.submit(update_history, args), failed_history, args) for args in pending.items()]
+            for f, failed, (key, value) in futures:
+                try:
+                    f.result()
+                except (ClientError, BotoCoreError) as e:
+                    # Don't fail the flush, retried with the next one
+                    print('[WARN] Failed to flush visits', e)
+                    failed[key] = value
+        self.requeue(failed_history, failed_cnts)
+        print(f'[INFO] Flushed {len(pending) - len(failed_history)} buffered visits to '
+              f'{len(attraction_cnts) - len(failed_cnts)} attractions, {len(failed_history) + len(failed_cnts)} failed')
+        return [aid for aid in attraction_cnts if aid not in failed_cnts]
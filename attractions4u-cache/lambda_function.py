@@ -1,23 +1,31 @@
-from decimal import Decimal
+from cache_codec import encode_value, supported_encodings, to_wire
 import json
 import redis
 import os
 
 
-r = redis.StrictRedis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], db=0, charset="utf-8", decode_responses=True)
+# Values are kept as bytes, they may be compressed
+r = redis.StrictRedis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], db=0, decode_responses=False)
 RESPONSE_TO_INVALID = {
     'body': json.dumps('Invalid request!'),
     'statusCode': 400,
     'headers': {"content-type": "application/json"}
 }
-DEFAULT_TTL = 15
+# Seconds, used when the request has no ttl. A ttl <= 0 means no expiry.
+DEFAULT_TTL = int(os.environ.get('DEFAULT_TTL', 15))
+ACCEPTED_WIRE_FORMATS = {'json', 'zlib'}
 
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return str(obj)
-        return json.JSONEncoder.default(self, obj)
+def get_ttls(data, n):
+    ttl = data.get('ttl', DEFAULT_TTL)
+    ttls = data.get('ttls') or [None] * n
+    if not isinstance(ttls, list) or len(ttls) != n:
+        return None
+    ttls = [ttl if t is None else t for t in ttls]
+    # Redis takes whole seconds only, anything else is an invalid request rather than a failed one
+    if not all(t is None or (isinstance(t, int) and not isinstance(t, bool)) for t in ttls):
+        return None
+    return ttls
 
 
 def lambda_handler(event, context):
@@ -32,26 +40,54 @@ def lambda_handler(event, context):
     keys = data['keys']
     res = []
 
-    if op == 'get' or op == 'del':
+    if op == 'get' or op == 'mget':
+        accept = data.get('accept', 'json')
+        if not len(keys) or accept not in ACCEPTED_WIRE_FORMATS:
+            return RESPONSE_TO_INVALID
+        res = [to_wire(v, accept) for v in r.mget(keys)]
+    elif op == 'del':
         if not len(keys):
             return RESPONSE_TO_INVALID
 
         pipe = r.pipeline()
-        func = pipe.get if op == 'get' else pipe.delete
         for k in keys:
-            func(k)
+            pipe.delete(k)
         res = pipe.execute()
-    elif op == 'set':
+    elif op == 'set' or op == 'mset':
+        if 'values' not in data:
+            return RESPONSE_TO_INVALID
+        values = data['values']
+        encoding = data.get('encoding', 'json')
+        if not len(keys) or len(keys) != len(values) or encoding not in supported_encodings():
+            return RESPONSE_TO_INVALID
+        ttls = get_ttls(data, len(keys))
+        if ttls is None:
+            return RESPONSE_TO_INVALID
+
+        encoded = [encode_value(v, encoding) for v in values]
+        if all(ttl is None or ttl <= 0 for ttl in ttls):
+            r.mset(dict(zip(keys, encoded)))
+            res = [True] * len(keys)
+        else:
+            pipe = r.pipeline(transaction=False)
+            for k, v, ttl in zip(keys, encoded, ttls):
+                pipe.set(k, v, ttl if ttl is not None and ttl > 0 else None)
+            res = pipe.execute()
+    elif op == 'add':
+        # Only sets the keys that don't exist yet, e.g. to take a lock
         if 'values' not in data:
             return RESPONSE_TO_INVALID
         values = data['values']
         if not len(keys) or len(keys) != len(values):
             return RESPONSE_TO_INVALID
+        ttls = get_ttls(data, len(keys))
+        if ttls is None:
+            return RESPONSE_TO_INVALID
 
-        pipe = r.pipeline()
-        for k, v in zip(keys, values):
-            pipe.set(k, json.dumps(v, cls=DecimalEncoder), DEFAULT_TTL)
-        res = pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for k, v, ttl in zip(keys, values, ttls):
+            pipe.set(k, encode_value(v), ttl if ttl is not None and ttl > 0 else None, nx=True)
+        res = [bool(added) for added in pipe.execute()]
     else:
         return RESPONSE_TO_INVALID
     
@@ -0,0 +1,233 @@
+import argparse
+import json
+import numpy as np
+import os
+
+
+# Inverted file (IVF) index over L2-normalized float32 vectors, scored by cosine similarity.
+# On disk an index is a directory with:
+#   vectors.npy    (N, d) float32, float16 or int8 codes, rows grouped by list, memory-mapped when loaded
+#   scale.npy      (d,) float32, int8 only: a code c stands for c * scale of its dimension
+#   centroids.npy  (nlist, d) float32
+#   offsets.npy    (nlist + 1,) int64, rows of list i are vectors[offsets[i]:offsets[i + 1]]
+#   ids.json       attraction ID of every row
+#   pca.npz        mean and components, only when reduced with --pca. The stored vectors and centroids are
+#                  already reduced, queries built from indexed vectors (centroids, profiles) need no projection
+
+BLOCK_ROWS = 4096
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
+def assign_lists(x, centroids):
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), BLOCK_ROWS):
+        assign[start:start + BLOCK_ROWS] = np.argmax(x[start:start + BLOCK_ROWS] @ centroids.T, axis=1)
+    return assign
+
+
+def train_centroids(x, nlist, iters=10, seed=0):
+    # Spherical k-means
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = assign_lists(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # Re-seed empty lists with random points
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+def fit_pca(x, dim):
+    mean = x.mean(0)
+    # Right singular vectors of the centered data are the principal axes
+    _, _, vt = np.linalg.svd(x - mean, full_matrices=False)
+    return mean.astype(np.float32), vt[:dim].astype(np.float32)
+
+
+def apply_pca(x, mean, components):
+    return normalize((x - mean) @ components.T)
+
+
+def quantize(x, dtype):
+    # Per-dimension symmetric scalar quantization
+    if dtype != 'int8':
+        return x.astype(dtype), None
+    scale = np.abs(x).max(0) / 127
+    scale[scale == 0] = 1
+    return np.clip(np.rint(x / scale), -127, 127).astype(np.int8), scale.astype(np.float32)
+
+
+def build_index(vectors, ids: list, out_dir, nlist=None, iters=10, dtype='float32', pca_dim=None):
+    x = normalize(vectors)
+    pca = None
+    if pca_dim:
+        pca = fit_pca(x, pca_dim)
+        x = apply_pca(x, *pca)
+    if nlist is None:
+        nlist = max(1, int(np.sqrt(len(x))))
+    nlist = min(nlist, len(x))
+    centroids = train_centroids(x, nlist, iters)
+    assign = assign_lists(x, centroids)
+    order = np.argsort(assign, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+
+    os.makedirs(out_dir, exist_ok=True)
+    codes, scale = quantize(x[order], dtype)
+    np.save(os.path.join(out_dir, 'vectors.npy'), codes)
+    if scale is not None:
+        np.save(os.path.join(out_dir, 'scale.npy'), scale)
+    np.save(os.path.join(out_dir, 'centroids.npy'), centroids)
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    if pca is not None:
+        np.savez(os.path.join(out_dir, 'pca.npz'), mean=pca[0], components=pca[1])
+    with open(os.path.join(out_dir, 'ids.json'), 'w') as f:
+        json.dump([ids[i] for i in order], f)
+
+
+class IVFIndex:
+    def __init__(self, index_dir, nprobe=8):
+        self.vectors = np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+        scale_path = os.path.join(index_dir, 'scale.npy')
+        self.scale = np.load(scale_path) if os.path.exists(scale_path) else None
+        self.centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+        pca_path = os.path.join(index_dir, 'pca.npz')
+        self.pca = None
+        if os.path.exists(pca_path):
+            with np.load(pca_path) as f:
+                self.pca = (f['mean'], f['components'])
+        with open(os.path.join(index_dir, 'ids.json')) as f:
+            self.ids = json.load(f)
+        self.rows = {aid: i for i, aid in enumerate(self.ids)}
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.ids)
+
+    def project(self, x):
+        # Vectors in the original embedding space into the index space
+        return normalize(x) if self.pca is None else apply_pca(normalize(x), *self.pca)
+
+    def decode(self, rows):
+        x = np.asarray(self.vectors[rows], dtype=np.float32)
+        return x if self.scale is None else x * self.scale
+
+    def vector(self, aid):
+        row = self.rows.get(aid)
+        return None if row is None else self.decode(row)
+
+    def centroid(self, aids: list, weights=None):
+        # Normalized (weighted) mean of the vectors of the given attractions, None if none is indexed
+        if weights is None:
+            weights = [1.0] * len(aids)
+        rows = [(self.rows[aid], w) for aid, w in zip(aids, weights) if aid in self.rows]
+        if not len(rows):
+            return None
+        w = np.asarray([w for _, w in rows], dtype=np.float32)
+        vecs = self.decode([r for r, _ in rows])
+        return normalize(w @ vecs)
+
+    def search(self, query, k, exclude=(), nprobe=None):
+        # Top-k attraction IDs with their cosine similarity to the query
+        query = normalize(query)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        cand_rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in probe])
+        if not len(cand_rows):
+            return []
+        # Scored on the codes, the int8 scale is folded into the query
+        scores = np.asarray(self.vectors[cand_rows], dtype=np.float32) @ (
+            query if self.scale is None else query * self.scale)
+
+        exclude = set(exclude)
+        k_cand = min(len(cand_rows), k + len(exclude))
+        top = np.argpartition(-scores, k_cand - 1)[:k_cand]
+        top = top[np.argsort(-scores[top])]
+        res = []
+        for i in top:
+            aid = self.ids[cand_rows[i]]
+            if aid not in exclude:
+                res.append((aid, float(scores[i])))
+                if len(res) == k:
+                    break
+        return res
+
+
+def exact_top_k(x, rows, k):
+    # Exact float32 cosine top-k of the given rows among all rows, the row itself left out
+    res = np.empty((len(rows), k), dtype=np.int64)
+    for start in range(0, len(rows), BLOCK_ROWS):
+        scores = x[rows[start:start + BLOCK_ROWS]] @ x.T
+        scores[np.arange(len(scores)), rows[start:start + BLOCK_ROWS]] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        res[start:start + BLOCK_ROWS] = top
+    return res
+
+
+def report_recall(vectors, ids: list, index, k=10, n_queries=1000, seed=0):
+    # Recall@k of index searches (IVF, storage dtype and PCA) against exact float32 cosine
+    # in the original space, queried with sampled indexed attractions
+    x = normalize(vectors)
+    k = min(k, len(x) - 1)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(x), min(n_queries, len(x)), replace=False)
+    exact = exact_top_k(x, rows, k)
+    hits = 0
+    for row, expected in zip(rows, exact):
+        found = index.search(index.project(x[row]), k, exclude=[ids[row]])
+        hits += len({ids[i] for i in expected}.intersection(aid for aid, _ in found))
+    return hits / exact.size
+
+
+def read_ids(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds an IVF index from saved embedding vectors')
+    parser.add_argument('--vectors', nargs='+', required=True,
+                        help='.npy files with one row per attraction, several files are concatenated (ensemble)')
+    id_source = parser.add_mutually_exclusive_group(required=True)
+    id_source.add_argument('--ids', help='text file with the attraction ID of every row')
+    id_source.add_argument('--ids-from-dir', help='image directory, sorted file names without extension are the IDs')
+    parser.add_argument('--out', required=True, help='index directory')
+    parser.add_argument('--nlist', type=int, default=None, help='number of inverted lists, sqrt(N) by default')
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'int8'], default='float32',
+                        help='storage of the vectors, int8 takes a quarter of the memory of float32')
+    parser.add_argument('--pca', type=int, default=None, help='reduce to this many dimensions first')
+    parser.add_argument('--nprobe', type=int, default=8, help='lists probed by the recall report')
+    parser.add_argument('--k', type=int, default=10, help='k of the recall@k report')
+    parser.add_argument('--queries', type=int, default=1000, help='sampled rows used for the recall report, 0 to skip')
+    args = parser.parse_args()
+
+    # Concatenated before normalization, as in visual-features/rank.py
+    vectors = np.concatenate([np.load(p) for p in args.vectors], axis=1)
+    if args.ids:
+        ids = read_ids(args.ids)
+    else:
+        ids = [p.split('.')[0] for p in sorted(os.listdir(args.ids_from_dir))]
+    if len(ids) != len(vectors):
+        raise ValueError(f'{len(ids)} IDs for {len(vectors)} vectors')
+    build_index(vectors, ids, args.out, args.nlist, args.iters, args.dtype, args.pca)
+    index = IVFIndex(args.out, args.nprobe)
+    print(f'Indexed {len(ids)} vectors of dimension {vectors.shape[1]} into {args.out}, '
+          f'{vectors.shape[1] * len(ids) * 4 / 2 ** 20:.1f} MiB float32 -> '
+          f'{index.vectors.nbytes / 2 ** 20:.1f} MiB {index.vectors.dtype} of dimension {index.vectors.shape[1]}')
+    if args.queries:
+        recall = report_recall(vectors, ids, index, args.k, args.queries)
+        print(f'recall@{args.k} at nprobe {args.nprobe}: {recall:.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+from cache_codec import DecimalEncoder, decode_value, encode_value, from_wire
+import json
+
+
+# Both backends read and write the same Redis values, see cache_codec.
+# get returns decoded values (None for missing keys), set takes a ttl in seconds where <= 0 means no expiry,
+# add only sets keys that don't exist yet and returns whether each one was set.
+
+
+class HttpCacheBackend:
+    # Goes through the attractions4u-cache Lambda
+
+    def __init__(self, http, url, headers, wire_format='zlib'):
+        self.http = http
+        self.url = url
+        self.headers = headers
+        self.wire_format = wire_format
+
+    def request(self, cache_req):
+        cache_res = self.http.request(
+            'POST',
+            self.url,
+            headers=self.headers,
+            body=json.dumps(cache_req, cls=DecimalEncoder)
+        )
+        return json.loads(cache_res.data.decode('utf8'))
+
+    def get(self, keys):
+        # The cache service rejects requests without keys
+        if not len(keys):
+            return []
+        res = self.request({'op': 'mget', 'keys': keys, 'accept': self.wire_format})
+        return [from_wire(v, self.wire_format) for v in res]
+
+    def set(self, keys, values, ttl, encoding='json'):
+        return self.request({'op': 'mset', 'keys': keys, 'values': values, 'ttl': ttl, 'encoding': encoding})
+
+    def add(self, keys, values, ttl):
+        return self.request({'op': 'add', 'keys': keys, 'values': values, 'ttl': ttl})
+
+    def delete(self, keys):
+        return self.request({'op': 'del', 'keys': keys})
+
+
+class RedisCacheBackend:
+    # Talks to Redis directly over pooled connections, one round trip per call
+
+    def __init__(self, host, port, max_connections=16, timeout=2.0):
+        import redis
+        pool = redis.BlockingConnectionPool(
+            host=host,
+            port=int(port),
+            db=0,
+            max_connections=max_connections,
+            timeout=timeout,
+            socket_timeout=timeout,
+            socket_connect_timeout=timeout
+        )
+        self.r = redis.StrictRedis(connection_pool=pool)
+
+    def get(self, keys):
+        return [decode_value(v) for v in self.r.mget(keys)]
+
+    def set(self, keys, values, ttl, encoding='json'):
+        encoded = [encode_value(v, encoding) for v in values]
+        if ttl is None or ttl <= 0:
+            self.r.mset(dict(zip(keys, encoded)))
+            return [True] * len(keys)
+        pipe = self.r.pipeline(transaction=False)
+        for k, v in zip(keys, encoded):
+            pipe.set(k, v, ttl)
+        return pipe.execute()
+
+    def add(self, keys, values, ttl):
+        pipe = self.r.pipeline(transaction=False)
+        for k, v in zip(keys, values):
+            pipe.set(k, encode_value(v), ttl if ttl is not None and ttl > 0 else None, nx=True)
+        return [bool(added) for added in pipe.execute()]
+
+    def delete(self, keys):
+        pipe = self.r.pipeline(transaction=False)
+        for k in keys:
+            pipe.delete(k)
+        return pipe.execute()
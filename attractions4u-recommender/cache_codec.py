@@ -0,0 +1,80 @@
+import base64
+from decimal import Decimal
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Values are stored as plain JSON text, or as bytes behind one of these markers.
+# Plain JSON never starts with a NUL byte, so values written before encodings existed still read fine.
+ZLIB_MARKER = b'\x00z'
+MSGPACK_MARKER = b'\x00m'
+
+# Values shorter than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def supported_encodings():
+    return {'json', 'zlib', 'msgpack'} if msgpack is not None else {'json', 'zlib'}
+
+
+def encode_value(value, encoding='json'):
+    # Python object -> bytes to store in Redis
+    if encoding == 'msgpack':
+        return MSGPACK_MARKER + msgpack.packb(value, default=str, use_bin_type=True)
+    text = json.dumps(value, cls=DecimalEncoder).encode('utf8')
+    if encoding == 'zlib' and len(text) >= COMPRESS_MIN_BYTES:
+        return ZLIB_MARKER + zlib.compress(text)
+    return text
+
+
+def decode_to_json(stored):
+    # Stored bytes -> JSON text, without parsing JSON values
+    if stored is None:
+        return None
+    if stored.startswith(ZLIB_MARKER):
+        return zlib.decompress(stored[len(ZLIB_MARKER):]).decode('utf8')
+    if stored.startswith(MSGPACK_MARKER):
+        return json.dumps(msgpack.unpackb(stored[len(MSGPACK_MARKER):], raw=False))
+    return stored.decode('utf8')
+
+
+def decode_value(stored):
+    # Stored bytes -> Python object
+    if stored is None:
+        return None
+    if stored.startswith(MSGPACK_MARKER):
+        return msgpack.unpackb(stored[len(MSGPACK_MARKER):], raw=False)
+    return json.loads(decode_to_json(stored))
+
+
+def to_wire(stored, accept='json'):
+    # Stored bytes -> the string sent back to HTTP clients, JSON text or base64 zlib-compressed JSON text
+    if stored is None:
+        return None
+    if accept == 'zlib':
+        if stored.startswith(ZLIB_MARKER):
+            # Already compressed, pass it through
+            return base64.b64encode(stored[len(ZLIB_MARKER):]).decode('ascii')
+        return base64.b64encode(zlib.compress(decode_to_json(stored).encode('utf8'))).decode('ascii')
+    return decode_to_json(stored)
+
+
+def from_wire(value, accept='json'):
+    # Inverse of to_wire, on the client side
+    if value is None:
+        return None
+    if accept == 'zlib':
+        value = zlib.decompress(base64.b64decode(value)).decode('utf8')
+    return json.loads(value)
@@ -1,54 +1,81 @@
+import time
+MODULE_START = time.perf_counter()
+
 import boto3
 from boto3.dynamodb.conditions import Key
+from cache_backend import HttpCacheBackend, RedisCacheBackend
+from cache_codec import DecimalEncoder
 from collections import Counter
-from decimal import Decimal
-import inflect
+from concurrent.futures import ThreadPoolExecutor
+from dynamo_batch import batch_get_items, thread_safe_client
 import json
-import nltk
+from lazy_init import Lazy, record_timing, reports_init, warm_up
 import os
 import random
-import time
+from text_norm import proc_attraction_type
 import urllib3
 
 
-dynamo = boto3.resource('dynamodb')
-attractionTable = dynamo.Table("attractions4u-attractions")
-profileTable = dynamo.Table("attractions4u-user-profiles")
-pageHistoryTable = dynamo.Table("attractions4u-page-history")
+record_timing('imports', MODULE_START)
+
+# Created on first use
+dynamo = Lazy('dynamodb', lambda: boto3.resource('dynamodb'))
+attractionTable = Lazy('attractionTable', lambda: dynamo.Table("attractions4u-attractions"))
+profileTable = Lazy('profileTable', lambda: dynamo.Table("attractions4u-user-profiles"))
+pageHistoryTable = Lazy('pageHistoryTable', lambda: dynamo.Table("attractions4u-page-history"))
+lambda_client = Lazy('lambda', lambda: boto3.client('lambda'))
+
+# Max number of users whose page histories and ES queries are in flight at the same time
+HISTORY_CONCURRENCY = int(os.environ.get('HISTORY_CONCURRENCY', 8))
+# Max number of queries per _msearch request
+ES_MSEARCH_BATCH_SIZE = int(os.environ.get('ES_MSEARCH_BATCH_SIZE', 50))
 
 cache_headers = urllib3.make_headers()
 cache_headers['Content-Type'] = 'application/json'
 es_headers = urllib3.make_headers(basic_auth='{}:{}'.format(os.environ['ES_U'], os.environ['ES_K']))
 es_headers['Content-Type'] = 'application/json'
-http = urllib3.PoolManager()
-CACHE_URL = os.environ['CACHE']
+http = urllib3.PoolManager(maxsize=HISTORY_CONCURRENCY)
+# 'http' goes through the cache Lambda at CACHE, 'redis' reads REDIS_HOST/REDIS_PORT directly
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'http')
+CACHE_URL = os.environ.get('CACHE')
+# Recommendations are rebuilt by the scheduled refresh, keep them until the next one
+RECOMMENDATION_CACHE_TTL = int(os.environ.get('RECOMMENDATION_CACHE_TTL', 26 * 3600))
+# How values are stored in Redis and sent back by the cache service
+CACHE_ENCODING = os.environ.get('CACHE_ENCODING', 'zlib')
+CACHE_WIRE_FORMAT = os.environ.get('CACHE_WIRE_FORMAT', 'zlib')
+# Seconds a recommendation list is served without being rebuilt in the background
+RECOMMENDATION_FRESH_TTL = int(os.environ.get('RECOMMENDATION_FRESH_TTL', 600))
+# Rebuild coordination: lock expiry (s) in case the rebuilding invocation dies, how long a request
+# waits for somebody else's rebuild on a miss and how often it checks (ms)
+REBUILD_LOCK_TTL = int(os.environ.get('REBUILD_LOCK_TTL', 60))
+COALESCE_WAIT_MS = int(os.environ.get('COALESCE_WAIT_MS', 3000))
+COALESCE_POLL_MS = int(os.environ.get('COALESCE_POLL_MS', 100))
+# Attractions are shared by all users' recommendations and change rarely
+ATTRACTION_CACHE_TTL = int(os.environ.get('ATTRACTION_CACHE_TTL', 3 * 24 * 3600))
+# Max number of attractions per cache write, keeps requests to the cache service small
+CACHE_SET_BATCH_SIZE = int(os.environ.get('CACHE_SET_BATCH_SIZE', 200))
 ES_URL = os.environ['ES'] + '/attractions/_search'
 ES_URL_MULTISEARCH = os.environ['ES'] + '/_msearch'
 
-NOUN_TAGS = {'NN', 'NNS', 'NNPS', 'NNP'}
-INFLECT = inflect.engine()
-
 RECOMMENDATION_RETURN_CNT = 36
-
-
-def proc_attraction_type(t: str):
-    if 'nature_reserves' in t:
-        t = 'nature_reserves'
-    t = t.replace('accomodation', 'accommodation')
-
-    res_tokens = []
-    for token, tag in nltk.pos_tag(t.split('_')):
-        if tag in NOUN_TAGS:
-            singular = INFLECT.singular_noun(token)
-            if singular:
-                if singular == 'biergarten':
-                    singular += ' beer garden'
-                res_tokens.append(singular)
-            else:
-                res_tokens.append(token)
-        else:
-            res_tokens.append(token)
-    return ' '.join(res_tokens)
+# Comma-separated directories of indexes built with ann_index.py, unset to use the descSimilar/visSimilar ES fields
+ANN_INDEX_DIRS = [d for d in os.environ.get('ANN_INDEX_DIRS', '').split(',') if d]
+ANN_NEIGHBOURS = int(os.environ.get('ANN_NEIGHBOURS', 100))
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', 8))
+# With ANN indexes, 'profile' retrieves history-based results with one query per index for the user's profile
+# vector, 'es' keeps the ES type/label searches over the most recent history rows
+HISTORY_RETRIEVAL = os.environ.get('HISTORY_RETRIEVAL', 'profile')
+# Visit weights halve every PROFILE_HALF_LIFE seconds. Profiles are updated from the changed history rows
+# and rebuilt from scratch every PROFILE_REBUILD_AGE seconds.
+PROFILE_HALF_LIFE = float(os.environ.get('PROFILE_HALF_LIFE', 30 * 24 * 3600))
+PROFILE_REBUILD_AGE = float(os.environ.get('PROFILE_REBUILD_AGE', 7 * 24 * 3600))
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 30 * 24 * 3600))
+# Batch refresh: profiles per scan page, profiles per cache write, and the remaining time (ms)
+# at which the refresh stops and hands its cursor over to a new invocation
+REFRESH_SCAN_PAGE_SIZE = int(os.environ.get('REFRESH_SCAN_PAGE_SIZE', 500))
+REFRESH_CHUNK_SIZE = int(os.environ.get('REFRESH_CHUNK_SIZE', 50))
+REFRESH_DEADLINE_MARGIN_MS = int(os.environ.get('REFRESH_DEADLINE_MARGIN_MS', 60000))
+REFRESH_SELF_INVOKE = os.environ.get('REFRESH_SELF_INVOKE', '1') == '1'
 
 
 def proc_attraction_types(types: list):
@@ -112,7 +139,7 @@ def get_es_query_body_for_pref(profile: dict):
     return query
 
 
-def es_multi_search(query_bodies: list):
+def es_multi_search_raw(query_bodies: list):
     request_body = ''
     for q in query_bodies:
         request_body += '{"index" : "attractions"} \n'
@@ -126,241 +153,462 @@ def es_multi_search(query_bodies: list):
     )
     es_res = json.loads(es_res.data.decode('utf8'))
     # print('[DEBUG]', es_res)
+    return [es_ret['hits']['hits'] for es_ret in es_res['responses']]
+
 
+def es_multi_search(query_bodies: list):
     all_ids = []
-    for es_ret in es_res['responses']:
-        all_ids.append(frozenset([r['_id'] for r in es_ret['hits']['hits']]))
+    for hits in es_multi_search_raw(query_bodies):
+        all_ids.append(frozenset([r['_id'] for r in hits]))
     return all_ids
 
 
+def run_concurrently(func, args: list, limit: int = HISTORY_CONCURRENCY):
+    if len(args) <= 1 or limit <= 1:
+        return [func(a) for a in args]
+    with ThreadPoolExecutor(max_workers=min(limit, len(args))) as pool:
+        return list(pool.map(func, args))
+
+
+def es_multi_search_batched(query_bodies: list, search_func=es_multi_search):
+    # Split into several _msearch requests so that one huge payload doesn't stall the others
+    batches = [query_bodies[i:i + ES_MSEARCH_BATCH_SIZE] for i in range(0, len(query_bodies), ES_MSEARCH_BATCH_SIZE)]
+    res = []
+    for batch_res in run_concurrently(search_func, batches):
+        res.extend(batch_res)
+    return res
+
+
 def search_by_prefs(profiles: list):
     profile_queries = [get_es_query_body_for_pref(p) for p in profiles]
-    return es_multi_search(profile_queries)
+    return es_multi_search_batched(profile_queries)
 
 
-def search_by_histories(usrs: list):
-    all_relevant_ids = []
-    for usr in usrs:
-        history = query_table_by_username(pageHistoryTable, usr)
-        history.sort(key=lambda row: (-row['lastVisit'], -row['cnt']))
-        history_ids = [row['attractionId'] for row in history[:5]]
-        es_query_body = {
-            "query": {
-                "function_score": {
-                    "query": { "ids": { "values": history_ids } },
-                    "random_score": {
-                        "seed": time.time_ns()
+def query_history(usr):
+    # All page history rows of the user, most recent first
+    history = thread_safe_client(dynamo).query(
+        TableName=pageHistoryTable.name,
+        KeyConditionExpression=Key('username').eq(usr)
+    ).get('Items', [])
+    history.sort(key=lambda row: (-row['lastVisit'], -row['cnt']))
+    return history
+
+
+def get_es_query_body_for_keywords(field: str, keywords: list):
+    return {
+        "size": 200,
+        "query": {
+            "function_score": {
+                "query": {
+                    "bool": {
+                        "should": [
+                            { "match_phrase": {field: keywordP} }
+                            for (keywordP, _) in keywords
+                        ]
                     }
+                },
+                "random_score": {
+                    "seed": time.time_ns()
                 }
-            },
-            "fields": ["visSimilar", "descSimilar", "attractionTypeP", "rekognitionLabels"],
-            "_source": False
-        }
-        es_res = http.request(
-            'GET',
-            ES_URL,
-            headers=es_headers,
-            body=json.dumps(es_query_body)
-        )
-        es_res = json.loads(es_res.data.decode('utf8'))["hits"]["hits"]
+            }
+        },
+        "fields": ["_id"],
+        "_source": False
+    }
+
+
+def load_ann_indexes():
+    if not len(ANN_INDEX_DIRS):
+        return []
+    from ann_index import IVFIndex
+    return [IVFIndex(d, ANN_NPROBE) for d in ANN_INDEX_DIRS]
+
+
+ann_indexes = Lazy('ann_indexes', load_ann_indexes)
+
+
+def search_similar(indexes: list, history_ids: list):
+    # Union of the nearest neighbours of the history centroid in every index (description, visual, ...)
+    res = set()
+    for index in indexes:
+        centroid = index.centroid(history_ids)
+        if centroid is not None:
+            res.update(aid for aid, _ in index.search(centroid, ANN_NEIGHBOURS, exclude=history_ids))
+    return res
+
+
+def profile_cache_key(email):
+    return f'uvec:{email}'
+
+
+def get_user_profiles(indexes: list, emails: list, histories: list):
+    # Profile vectors per user and index, cached profiles are updated from the history rows that changed
+    if not len(emails):
+        return []
+    # Imported here like ann_index, numpy is only needed when indexes are configured
+    from user_profile import profile_vectors, update_profile
+    now = time.time()
+    entries = cache_get([profile_cache_key(email) for email in emails])
+    changed_keys, changed_entries = [], []
+    res = []
+    for email, entry, history in zip(emails, entries, histories):
+        entry, changed = update_profile(indexes, entry, history, now, PROFILE_HALF_LIFE, PROFILE_REBUILD_AGE)
+        if changed:
+            changed_keys.append(profile_cache_key(email))
+            changed_entries.append(entry)
+        res.append(profile_vectors(entry))
+    if len(changed_keys):
+        cache_set(changed_keys, changed_entries, PROFILE_CACHE_TTL)
+    return res
+
+
+def search_by_profiles(indexes: list, usrs: list, all_history: list, active: list, timings: dict):
+    # One vector query per index for each user's profile replaces the ES history searches
+    all_relevant_ids = [set() for _ in usrs]
+    if not len(active):
+        return all_relevant_ids
+    t = time.perf_counter()
+    all_profiles = get_user_profiles(indexes, [usrs[i] for i in active], [all_history[i] for i in active])
+    for i, vecs in zip(active, all_profiles):
+        visited = [row['attractionId'] for row in all_history[i]]
+        for index, vec in zip(indexes, vecs):
+            if vec is not None:
+                all_relevant_ids[i].update(aid for aid, _ in index.search(vec, ANN_NEIGHBOURS, exclude=visited))
+    timings['profiles'] = time.perf_counter() - t
+    return all_relevant_ids
+
+
+def search_by_histories(usrs: list):
+    timings = {}
+
+    # Stage 1: page histories of all users in parallel
+    t = time.perf_counter()
+    all_history = run_concurrently(query_history, usrs)
+    timings['history'] = time.perf_counter() - t
+
+    # Users without any history can't get history-based results, skip them in ES
+    active = [i for i, history in enumerate(all_history) if len(history)]
+
+    # With ANN indexes, neighbours of the history centroid replace the static similarity lists
+    indexes = ann_indexes.instance()
+    if len(indexes) and HISTORY_RETRIEVAL == 'profile':
+        all_relevant_ids = search_by_profiles(indexes, usrs, all_history, active, timings)
+    else:
+        all_relevant_ids = search_by_recent_history(indexes, usrs, all_history, active, timings)
+
+    print('[INFO] search_by_histories users={} active={} {}'.format(
+        len(usrs), len(active), ' '.join(f'{k}={v * 1000:.1f}ms' for k, v in timings.items())))
+    return all_relevant_ids
+
+
+def search_by_recent_history(indexes: list, usrs: list, all_history: list, active: list, timings: dict):
+    # ES searches for the types and labels of each user's recently visited attractions
+    all_history_ids = [[row['attractionId'] for row in history[:5]] for history in all_history]
+    fields = ["attractionTypeP", "rekognitionLabels"]
+    if not len(indexes):
+        fields += ["visSimilar", "descSimilar"]
+
+    # Stage 2: fields of the recently visited attractions, one _msearch for many users
+    t = time.perf_counter()
+    ids_queries = [{
+        "size": len(all_history_ids[i]),
+        "query": {
+            "function_score": {
+                "query": { "ids": { "values": all_history_ids[i] } },
+                "random_score": {
+                    "seed": time.time_ns()
+                }
+            }
+        },
+        "fields": fields,
+        "_source": False
+    } for i in active]
+    all_history_hits = es_multi_search_batched(ids_queries, es_multi_search_raw)
+    timings['ids'] = time.perf_counter() - t
 
+    all_similar_ids = []
+    keyword_queries = []
+    for es_res in all_history_hits:
         relevant_ids = set()
         type_cntr = Counter()
         label_cntr = Counter()
         for ret in es_res:
-            fields = ret["fields"]
-            relevant_ids.update(fields["visSimilar"])
-            relevant_ids.update(fields.get("descSimilar", []))
-            type_cntr.update(fields["attractionTypeP"])
-            label_cntr.update(fields.get("rekognitionLabels", []))
-
-        # Get attractions of relevant types
+            hit_fields = ret["fields"]
+            relevant_ids.update(hit_fields.get("visSimilar", []))
+            relevant_ids.update(hit_fields.get("descSimilar", []))
+            type_cntr.update(hit_fields["attractionTypeP"])
+            label_cntr.update(hit_fields.get("rekognitionLabels", []))
+        all_similar_ids.append(relevant_ids)
+
+        # Get attractions of relevant types and labels
         del type_cntr["interesting place"]
-        relevant_types = type_cntr.most_common()[:15]
-        type_query_body = {
-            "size": 200,
-            "query": {
-                "function_score": {
-                    "query": {
-                        "bool": {
-                            "should": [
-                                { "match_phrase": {"attractionTypeP": keywordP} }
-                                for (keywordP, _) in relevant_types
-                            ]
-                        }
-                    },
-                    "random_score": {
-                        "seed": time.time_ns()
-                    }
-                }
-            },
-            "fields": ["_id"],
-            "_source": False
-        }
-        type_res = http.request(
-            'GET',
-            ES_URL,
-            headers=es_headers,
-            body=json.dumps(type_query_body)
-        )
-        type_res = json.loads(type_res.data.decode('utf8'))["hits"]["hits"]
-        relevant_ids2 = set(r["_id"] for r in type_res)
-
-        # Get attractions of relevant labels
-        relevant_labels = label_cntr.most_common()[:15]
-        label_query_body = {
-            "size": 200,
-            "query": {
-                "function_score": {
-                    "query": {
-                        "bool": {
-                            "should": [
-                                { "match_phrase": {"rekognitionLabels": keywordP} }
-                                for (keywordP, _) in relevant_labels
-                            ]
-                        }
-                    },
-                    "random_score": {
-                        "seed": time.time_ns()
-                    }
-                }
-            },
-            "fields": ["_id"],
-            "_source": False
-        }
-        label_res = http.request(
-            'GET',
-            ES_URL,
-            headers=es_headers,
-            body=json.dumps(label_query_body)
-        )
-        label_res = json.loads(label_res.data.decode('utf8'))["hits"]["hits"]
-        relevant_ids3 = set(r["_id"] for r in label_res)
-
-        relevant_ids = relevant_ids & (relevant_ids2 | relevant_ids3)
-
-        all_relevant_ids.append(relevant_ids)
+        keyword_queries.append(get_es_query_body_for_keywords("attractionTypeP", type_cntr.most_common()[:15]))
+        keyword_queries.append(get_es_query_body_for_keywords("rekognitionLabels", label_cntr.most_common()[:15]))
+
+    if len(indexes):
+        t = time.perf_counter()
+        for j, i in enumerate(active):
+            all_similar_ids[j] = search_similar(indexes, all_history_ids[i])
+        timings['ann'] = time.perf_counter() - t
+
+    # Stage 3: type and label queries of all users combined into _msearch batches
+    t = time.perf_counter()
+    all_keyword_ids = es_multi_search_batched(keyword_queries)
+    timings['keywords'] = time.perf_counter() - t
+
+    all_relevant_ids = [set() for _ in usrs]
+    for j, i in enumerate(active):
+        ids_by_type, ids_by_label = all_keyword_ids[2 * j], all_keyword_ids[2 * j + 1]
+        all_relevant_ids[i] = all_similar_ids[j] & (ids_by_type | ids_by_label)
     return all_relevant_ids
 
 
-def batch_query_table(table_name, keys):
-    query = {}
-    query[table_name] = {"Keys": keys}
-    response = dynamo.batch_get_item(
-        RequestItems=query
-    )
-    return response['Responses'][table_name]
+def create_cache_backend():
+    if CACHE_BACKEND == 'redis':
+        return RedisCacheBackend(
+            os.environ['REDIS_HOST'],
+            os.environ['REDIS_PORT'],
+            max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', HISTORY_CONCURRENCY * 2))
+        )
+    return HttpCacheBackend(http, CACHE_URL, cache_headers, CACHE_WIRE_FORMAT)
 
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return str(obj)
-        return json.JSONEncoder.default(self, obj)
+cache = Lazy('cache', create_cache_backend)
 
 
 def cache_get(keys):
-    cache_req = {
-        'op': 'get',
-        'keys': keys
-    }
-    cache_res = http.request(
-        'POST',
-        CACHE_URL,
-        headers=cache_headers,
-        body=json.dumps(cache_req, cls=DecimalEncoder)
-    )
-    return json.loads(cache_res.data.decode('utf8'))
+    # Returns the cached values, already decoded, or None for missing keys
+    return cache.get(keys)
 
 
-def cache_set(keys, values):
-    cache_req = {
-        'op': 'set',
-        'keys': keys,
-        'values': values
-    }
-    cache_res = http.request(
-        'POST',
-        CACHE_URL,
-        headers=cache_headers,
-        body=json.dumps(cache_req, cls=DecimalEncoder)
-    )
-    return json.loads(cache_res.data.decode('utf8'))
+def cache_set(keys, values, ttl=None):
+    return cache.set(keys, values, RECOMMENDATION_CACHE_TTL if ttl is None else ttl, CACHE_ENCODING)
 
 
-def get_recommendations(profiles: list, emails: list):
+def get_recommendation_ids(profiles: list, emails: list):
     res = []
     all_ids_by_pref = search_by_prefs(profiles)
     all_ids_by_history = search_by_histories(emails)
 
     for ids_by_pref, ids_by_history in zip(all_ids_by_pref, all_ids_by_history):
-        ret = []
-
         # Ensure user pref priority
         ids_by_pref = frozenset(random.sample(ids_by_pref, min(100, len(ids_by_pref))))
         ids_by_history = frozenset(random.sample(ids_by_history, min(30, len(ids_by_history))))
 
-        ids_for_usr = [{'attractionId': aid} for aid in (ids_by_pref | ids_by_history)]
-        if len(ids_for_usr):
-            if len(ids_for_usr) > 100:
-                # DynamoDB batchGet limit is 100
-                random.seed(time.time_ns())
-                random.shuffle(ids_for_usr)
-                ids_for_usr = ids_for_usr[:100] 
-
-            ret = batch_query_table('attractions4u-attractions', ids_for_usr)
-            for i in range(len(ret)):
-                if 'restaurants' not in ret[i]:
-                    ret[i]['restaurants'] = []
-                if 'weekday_text' not in ret[i]['opening_hours']:
-                    ret[i]['opening_hours']['weekday_text'] = []
-        res.append(ret)
+        ids_for_usr = list(ids_by_pref | ids_by_history)
+        random.seed(time.time_ns())
+        random.shuffle(ids_for_usr)
+        res.append(ids_for_usr)
+    return res
+
+
+def recommendation_cache_key(email):
+    return f'rec:{email}'
+
+
+def attraction_cache_key(aid):
+    return f'attraction:{aid}'
+
+
+def hydrate_attractions(ids: list):
+    items = batch_get_items(dynamo, attractionTable.name, [{'attractionId': aid} for aid in ids])
+    for item in items:
+        if 'restaurants' not in item:
+            item['restaurants'] = []
+        if 'weekday_text' not in item['opening_hours']:
+            item['opening_hours']['weekday_text'] = []
+    return items
+
+
+def cache_attractions(items: list):
+    # Each attraction is stored once and shared by all users' recommendation lists
+    for i in range(0, len(items), CACHE_SET_BATCH_SIZE):
+        batch = items[i:i + CACHE_SET_BATCH_SIZE]
+        cache_set([attraction_cache_key(item['attractionId']) for item in batch], batch, ATTRACTION_CACHE_TTL)
+
+
+def get_attractions(ids: list):
+    # Cached attractions with one MGET, the missing ones are read from DynamoDB and cached
+    if not len(ids):
+        return []
+    cached = cache_get([attraction_cache_key(aid) for aid in ids])
+    missing = [aid for aid, item in zip(ids, cached) if item is None]
+    fetched = {}
+    if len(missing):
+        fetched = {item['attractionId']: item for item in hydrate_attractions(missing)}
+        cache_attractions(list(fetched.values()))
+    res = []
+    for aid, item in zip(ids, cached):
+        item = item if item is not None else fetched.get(aid)
+        if item is not None:
+            res.append(item)
     return res
 
 
+def recommendation_entry(ids: list):
+    # builtAt tells readers whether the entry is stale
+    return {'ids': ids, 'builtAt': time.time()}
+
+
+def is_stale(entry: dict):
+    return time.time() - entry['builtAt'] > RECOMMENDATION_FRESH_TTL
+
+
+def update_recommendations(profiles: list, emails: list, hydrate=True):
+    # Caches the ranked ID lists of the users and, if asked to, the attractions in them
+    all_ids = get_recommendation_ids(profiles, emails)
+    cache_set([recommendation_cache_key(email) for email in emails], [recommendation_entry(ids) for ids in all_ids])
+    unique_ids = list({aid for ids in all_ids for aid in ids})
+    if hydrate and len(unique_ids):
+        cache_attractions(hydrate_attractions(unique_ids))
+    return all_ids
+
+
+def rebuild_lock_key(email):
+    return f'lock:rec:{email}'
+
+
+def acquire_rebuild_lock(email):
+    # Single flight: only the caller that gets the lock rebuilds the user's recommendations
+    return cache.add([rebuild_lock_key(email)], [1], REBUILD_LOCK_TTL)[0]
+
+
+def release_rebuild_locks(emails: list):
+    cache.delete([rebuild_lock_key(email) for email in emails])
+
+
+def rebuild_user_recommendations(emails: list):
+    try:
+        # Inside the try, a user without a profile row must not keep the locks until they expire
+        profiles = [query_table_by_username(profileTable, email)[0] for email in emails]
+        # print('[DEBUG] Visitor Profile', profiles)
+        # Attractions are hydrated on read
+        return update_recommendations(profiles, emails, hydrate=False)
+    finally:
+        release_rebuild_locks(emails)
+
+
+def revalidate_in_background(email, context):
+    if not acquire_rebuild_lock(email):
+        # Someone is already refreshing this user
+        return
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'refreshUsers': [email]})
+    )
+
+
+def get_user_recommendation_ids(email, context):
+    # Stale-while-revalidate: a stale list is served as is and rebuilt asynchronously.
+    # On a miss concurrent requests for the same user wait for a single rebuild.
+    entry = cache_get([recommendation_cache_key(email)])[0]
+    if isinstance(entry, list):
+        # Written before entries had a build time
+        entry = {'ids': entry, 'builtAt': 0}
+    if entry is not None:
+        if is_stale(entry):
+            revalidate_in_background(email, context)
+        return entry['ids']
+
+    if acquire_rebuild_lock(email):
+        return rebuild_user_recommendations([email])[0]
+
+    deadline = time.monotonic() + COALESCE_WAIT_MS / 1000
+    while time.monotonic() < deadline:
+        time.sleep(COALESCE_POLL_MS / 1000)
+        entry = cache_get([recommendation_cache_key(email)])[0]
+        if entry is not None:
+            return entry['ids']
+
+    # The rebuild in flight is taking too long, don't keep the user waiting on it
+    print('[WARN] Gave up waiting for the rebuild of', email)
+    profile = query_table_by_username(profileTable, email)[0]
+    return get_recommendation_ids([profile], [email])[0]
+
+
+def scan_profile_pages(start_key=None):
+    scan_kwargs = {'Limit': REFRESH_SCAN_PAGE_SIZE}
+    while True:
+        if start_key is not None:
+            scan_kwargs['ExclusiveStartKey'] = start_key
+        page = profileTable.scan(**scan_kwargs)
+        yield start_key, page['Items']
+        start_key = page.get('LastEvaluatedKey')
+        if start_key is None:
+            return
+
+
+def refresh_all_recommendations(context, cursor=None):
+    # Walks the profile table page by page and writes each chunk to the cache as soon as it's done.
+    # Returns a cursor to resume from if the invocation is about to time out, otherwise None.
+    cursor = cursor or {}
+    offset = cursor.get('offset', 0)
+    processed = 0
+    for page_key, profiles in scan_profile_pages(cursor.get('startKey')):
+        while offset < len(profiles):
+            # Always make some progress so that a resumed refresh can't loop forever
+            if processed and context is not None and context.get_remaining_time_in_millis() < REFRESH_DEADLINE_MARGIN_MS:
+                print(f'[INFO] Refresh checkpointed after {processed} profiles')
+                return {'startKey': page_key, 'offset': offset}
+            chunk = profiles[offset:offset + REFRESH_CHUNK_SIZE]
+            update_recommendations(chunk, [p['username'] for p in chunk])
+            offset += len(chunk)
+            processed += len(chunk)
+        offset = 0
+    print(f'[INFO] Refresh finished, {processed} profiles')
+    return None
+
+
+@reports_init
 def lambda_handler(event, context):
+    if event.get('warmup'):
+        # Scheduled ping, initialize everything (or the listed dependencies) without doing any work
+        names = event['warmup'] if isinstance(event['warmup'], list) else None
+        return {
+            'statusCode': 200,
+            'body': json.dumps(warm_up(names))
+        }
+
     if 'requestContext' in event:
         # User asks for recommendation
         email = event['requestContext']['authorizer']['jwt']['claims']['email']
 
-        # Try reading from cache
-        cached_usr_res = cache_get([email])[0]
-        if cached_usr_res is not None:
-            cached_usr_res = json.loads(cached_usr_res)
-            random.seed(time.time_ns())
-            random.shuffle(cached_usr_res)
-            return {
-                'statusCode': 200,
-                'body': json.dumps(cached_usr_res[:RECOMMENDATION_RETURN_CNT], cls=DecimalEncoder),
-                'headers': {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Origin": "*"
-                }
-            }
-
-        # Cache miss
-        profile = query_table_by_username(profileTable, email)[0]
-        # print('[DEBUG] Visitor Profile', profile)
-        usr_res = get_recommendations([profile], [email])[0]
+        usr_ids = get_user_recommendation_ids(email, context)
 
-        cache_set([email], [usr_res])
+        # Only the attractions that are returned get decoded
         random.seed(time.time_ns())
-        random.shuffle(usr_res)
+        random.shuffle(usr_ids)
+        usr_res = get_attractions(usr_ids[:RECOMMENDATION_RETURN_CNT])
         return {
             'statusCode': 200,
-            'body': json.dumps(usr_res[:RECOMMENDATION_RETURN_CNT], cls=DecimalEncoder),
+            'body': json.dumps(usr_res, cls=DecimalEncoder),
             'headers': {
                 "Content-Type": "application/json",
                 "Access-Control-Allow-Origin": "*"
             }
         }
+    elif 'refreshUsers' in event:
+        # Asynchronous revalidation of stale recommendations
+        rebuild_user_recommendations(event['refreshUsers'])
+        return {
+            'statusCode': 200
+        }
     else:
-        # Periodically triggered by CloudWatch to batch update recommendations for all users
+        # Periodically triggered by CloudWatch to batch update recommendations for all users,
+        # or re-invoked by itself with a cursor to resume an unfinished refresh
         # print('[DEBUG] Triggered')
-        profiles = profileTable.scan()['Items']
-        emails = [p['username'] for p in profiles]
-        res = get_recommendations(profiles, emails)
-        cache_set(emails, res)
+        cursor = refresh_all_recommendations(context, event.get('refreshCursor'))
+        if cursor is not None and REFRESH_SELF_INVOKE:
+            lambda_client.invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps({'refreshCursor': cursor}, cls=DecimalEncoder)
+            )
         return {
-            'statusCode': 200
+            'statusCode': 200,
+            'refreshCursor': cursor
         }
+
+
+record_timing('module', MODULE_START)
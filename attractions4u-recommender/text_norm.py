@@ -0,0 +1,132 @@
+from functools import lru_cache
+from lazy_init import Lazy
+import os
+import string
+import sys
+
+
+def load_tagger():
+    import nltk
+    # The first call loads the tagger model
+    nltk.pos_tag(['warm'])
+    return nltk.pos_tag
+
+
+def load_inflect():
+    import inflect
+    return inflect.engine()
+
+
+NOUN_TAGS = {'NN', 'NNS', 'NNPS', 'NNP'}
+# Imported on first use, routes that never normalize text don't pay for nltk and inflect
+POS_TAG = Lazy('nltk', load_tagger)
+INFLECT = Lazy('inflect', load_inflect)
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+MEMO_SIZE = int(os.environ.get('TEXT_NORM_MEMO_SIZE', 4096))
+VOCAB_PATH = os.environ.get(
+    'ATTRACTION_TYPE_VOCAB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attraction_types.txt')
+)
+
+
+def singularize_nouns(tokens: list):
+    res_tokens = []
+    for token, tag in POS_TAG(tokens):
+        if tag in NOUN_TAGS:
+            singular = INFLECT.singular_noun(token)
+            if singular:
+                res_tokens.append(singular)
+            else:
+                res_tokens.append(token)
+        else:
+            res_tokens.append(token)
+    return res_tokens
+
+
+def attraction_type_tokens(t: str):
+    if 'nature_reserves' in t:
+        t = 'nature_reserves'
+    t = t.replace('accomodation', 'accommodation')
+    return t.split('_')
+
+
+def join_attraction_type(tokens: list, res_tokens: list):
+    return ' '.join([
+        singular + ' beer garden' if singular == 'biergarten' and singular != token else singular
+        for token, singular in zip(tokens, res_tokens)
+    ])
+
+
+def proc_attraction_type_uncached(t: str):
+    tokens = attraction_type_tokens(t)
+    return join_attraction_type(tokens, singularize_nouns(tokens))
+
+
+def usr_query_tokens(query_str: str):
+    return query_str.replace('_', ' ').translate(PUNCTUATION_TABLE).split()
+
+
+def proc_usr_query_uncached(query_str: str):
+    return ' '.join(singularize_nouns(usr_query_tokens(query_str)))
+
+
+def load_vocab(path=VOCAB_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def build_tables(vocab: list):
+    # Whole attraction type -> normalized string, and token -> normalized token for the tokens
+    # that come out the same in every vocabulary entry they appear in
+    type_table = {}
+    token_table = {}
+    ambiguous = set()
+    for t in vocab:
+        tokens = attraction_type_tokens(t)
+        res_tokens = singularize_nouns(tokens)
+        type_table[t] = join_attraction_type(tokens, res_tokens)
+        for token, singular in zip(tokens, res_tokens):
+            if token_table.setdefault(token, singular) != singular:
+                ambiguous.add(token)
+    for token in ambiguous:
+        del token_table[token]
+    return type_table, token_table
+
+
+# Built once per container, on first use
+TABLES = Lazy('text_norm_tables', lambda: build_tables(load_vocab()))
+
+
+def lookup_tokens(tokens: list):
+    # Skips the POS tagger when every token is already known
+    token_table = TABLES.instance()[1]
+    if len(tokens) and all(token in token_table for token in tokens):
+        return [token_table[token] for token in tokens]
+    return singularize_nouns(tokens)
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def proc_attraction_type(t: str):
+    res = TABLES.instance()[0].get(t)
+    if res is None:
+        tokens = attraction_type_tokens(t)
+        res = join_attraction_type(tokens, lookup_tokens(tokens))
+    return res
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def proc_usr_query(query_str: str):
+    # Tagged in full, the tags of free text tokens depend on their context and may differ from the vocabulary's
+    return proc_usr_query_uncached(query_str)
+
+
+if __name__ == '__main__':
+    # Shows what the lookup tables built from the vocabulary file look like
+    vocab = load_vocab(sys.argv[1]) if len(sys.argv) > 1 else load_vocab()
+    type_table, token_table = build_tables(vocab)
+    for t in vocab:
+        print(f'{t} -> {type_table[t]}')
+    print(f'{len(token_table)} unambiguous tokens')
@@ -0,0 +1,94 @@
+import base64
+from datetime import datetime
+import numpy as np
+
+
+# User profile vectors: per ANN index (description, visual, ...) the sum of the vectors of the attractions in the
+# user's page history, each weighted by cnt * 0.5 ** (age / half life). Time passing scales the whole sum by the
+# same factor, so a stored profile is brought up to date from the history rows that changed since alone.
+# Stored entry:
+#   {'updatedAt': s, 'builtAt': s, 'seen': {attractionId: [cnt, lastVisit s]},
+#    'vecs': [base64 float16 unit vector or None per index], 'norms': [float per index]}
+
+
+def visit_time(value):
+    # Seconds since the epoch, lastVisit is time_ns() from the Python Lambda or an ISO string from the Node one
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    return float(value) / 1e9
+
+
+def encode_vector(v):
+    return base64.b64encode(np.asarray(v, dtype=np.float16).tobytes()).decode('ascii')
+
+
+def decode_vector(s):
+    return np.frombuffer(base64.b64decode(s), dtype=np.float16).astype(np.float32)
+
+
+def decay(seconds, half_life):
+    return 0.5 ** (max(seconds, 0) / half_life)
+
+
+def history_state(history):
+    return {row['attractionId']: [int(row['cnt']), visit_time(row['lastVisit'])] for row in history}
+
+
+def load_sums(indexes, entry):
+    sums = []
+    for index, vec, norm in zip(indexes, entry['vecs'], entry['norms']):
+        sums.append(np.zeros(index.vectors.shape[1], dtype=np.float32) if vec is None else decode_vector(vec) * norm)
+    return sums
+
+
+def dump_entry(sums, seen, now, built_at):
+    vecs, norms = [], []
+    for s in sums:
+        norm = float(np.linalg.norm(s))
+        # Stored as a unit vector and its length so float16 neither overflows nor loses small sums
+        vecs.append(encode_vector(s / norm) if norm > 0 else None)
+        norms.append(norm)
+    return {'updatedAt': now, 'builtAt': built_at, 'seen': seen, 'vecs': vecs, 'norms': norms}
+
+
+def add_visits(indexes, sums, visits, now, half_life, sign=1.0):
+    # visits: attractionId -> [cnt, lastVisit]
+    for index, s in zip(indexes, sums):
+        for aid, (cnt, last_visit) in visits.items():
+            v = index.vector(aid)
+            if v is not None:
+                s += sign * cnt * decay(now - last_visit, half_life) * v
+
+
+def build_profile(indexes, history, now, half_life):
+    seen = history_state(history)
+    sums = [np.zeros(index.vectors.shape[1], dtype=np.float32) for index in indexes]
+    add_visits(indexes, sums, seen, now, half_life)
+    return dump_entry(sums, seen, now, now)
+
+
+def update_profile(indexes, entry, history, now, half_life, rebuild_age):
+    # Returns the up to date entry and whether it changed
+    if entry is None or now - entry['builtAt'] > rebuild_age or len(entry['vecs']) != len(indexes) or any(
+            vec is not None and len(decode_vector(vec)) != index.vectors.shape[1]
+            for index, vec in zip(indexes, entry['vecs'])):
+        # New user, indexes changed, or time to clear the rounding of many float16 updates
+        return build_profile(indexes, history, now, half_life), True
+
+    seen = entry['seen']
+    current = history_state(history)
+    old = {aid: seen[aid] for aid in seen if current.get(aid) != seen[aid]}
+    new = {aid: visit for aid, visit in current.items() if seen.get(aid) != visit}
+    if not len(old) and not len(new):
+        return entry, False
+
+    factor = decay(now - entry['updatedAt'], half_life)
+    sums = [s * factor for s in load_sums(indexes, entry)]
+    add_visits(indexes, sums, old, now, half_life, sign=-1.0)
+    add_visits(indexes, sums, new, now, half_life)
+    return dump_entry(sums, current, now, entry['builtAt']), True
+
+
+def profile_vectors(entry):
+    # Unit profile vector per index, None where the user has no indexed history
+    return [None if vec is None else decode_vector(vec) for vec in entry['vecs']]
@@ -0,0 +1,102 @@
+# Benchmark of the recommender_example ingestion against the per-row loops it replaced.
+# Run from the repository root: python benchmarks/bench_ingest.py [max items, default 100000]
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import recommender_example  # noqa: E402
+
+# The loops rescan the catalogue for every purchase, so they are only timed up to this size
+LEGACY_MAX_ITEMS = 10000
+# Purchase lists looked up per catalogue, as a worker or batch run serving many users would
+LOOKUP_USERS = 100
+
+
+def make_items(n, n_users, seed=0):
+    rnd = random.Random(seed)
+    users = [f'user{i}' for i in range(n_users)]
+    items = []
+    for i in range(n):
+        buyers = rnd.sample(users, rnd.randint(0, 3))
+        comments = [{'rating': rnd.randint(1, 10), 'author': rnd.choice(buyers + users[:1])}
+                    for _ in range(rnd.randint(0, 3))]
+        items.append({'item_id': str(i), 'description': f'It is item {i}.', 'comments': comments,
+                      'buyer': ','.join(buyers)})
+    return items
+
+
+def legacy_ingest(items):
+    # The former __main__ loops, condensed
+    df_1 = pd.DataFrame(items)
+    new_buyer = [b.split(',') if len(b) > 0 else [] for b in df_1['buyer']]
+    all_rate, all_buyer = [], []
+    for index, c in enumerate(df_1['comments'].array):
+        all_rate.append([i['rating'] for i in c if i['author'] in new_buyer[index]])
+        all_buyer.append([i['author'] for i in c if i['author'] in new_buyer[index]])
+    df_1['buyer'] = new_buyer
+    new_list = [[j for j in i if not isinstance(j, list)] for i in df_1.drop(columns=['comments']).to_numpy()]
+    final_version = []
+    for index, i in enumerate(all_buyer):
+        for rating_index, j in enumerate(i):
+            final_version.append(new_list[index] + [all_rate[index][rating_index], j])
+    final_ver_df = pd.DataFrame(final_version, columns=['item_id', 'description', 'rating', 'buyer'])
+    return df_1, final_ver_df
+
+
+def legacy_lookup(df_1, usernames):
+    # The former get_purchase_list, one catalogue scan per user
+    res = []
+    for username in usernames:
+        purchase_list = []
+        for b in df_1['buyer']:
+            if username in b:
+                purchase_list.append(df_1.loc[df_1['buyer'].astype(str) == str(b)]['item_id'].array[0])
+        res.append(purchase_list)
+    return res
+
+
+def new_ingest(items):
+    _, purchases, ratings = recommender_example.build_interactions(items)
+    return recommender_example.build_purchase_index(purchases), ratings
+
+
+def new_lookup(index, usernames):
+    return [recommender_example.get_purchase_list(username, index) for username in usernames]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - start, res
+
+
+def main():
+    max_items = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f'{"items":>8} {"ratings":>8} | {"ingest loops":>13} {"columnar":>10} | '
+          f'{LOOKUP_USERS} lookups {"scans":>8} {"index":>10}')
+    n = 10
+    while n <= max_items:
+        items = make_items(n, max(10, n // 5))
+        usernames = [f'user{i}' for i in range(LOOKUP_USERS)]
+        new_t, (index, ratings) = timed(new_ingest, items)
+        lookup_t, _ = timed(new_lookup, index, usernames)
+        if n <= LEGACY_MAX_ITEMS:
+            old_t, (df_1, old_ratings) = timed(legacy_ingest, items)
+            old_lookup_t, _ = timed(legacy_lookup, df_1, usernames)
+            if len(old_ratings) != len(ratings):
+                print(f'  rating count mismatch: {len(old_ratings)} vs {len(ratings)}')
+            old = f'{old_t * 1000:>11.1f}ms'
+            old_lookup = f'{old_lookup_t * 1000:>9.1f}ms'
+        else:
+            old, old_lookup = f'{"-":>13}', f'{"-":>11}'
+        print(f'{n:>8} {len(ratings):>8} | {old} {new_t * 1000:>8.1f}ms | '
+              f'{"":>{len(str(LOOKUP_USERS)) + 8}} {old_lookup} {lookup_t * 1000:>8.2f}ms')
+        n *= 10
+
+
+if __name__ == '__main__':
+    main()
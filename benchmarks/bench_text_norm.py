@@ -0,0 +1,100 @@
+# Micro-benchmark of text_norm against the per-call normalization it replaced, with a check that both
+# give the same results. The originals below are verbatim copies of the pre-text_norm Lambda code.
+# Run from the repository root: python benchmarks/bench_text_norm.py [attractions4u-recommender|attractions4u-attraction-py]
+import inflect
+import nltk
+import os
+import random
+import string
+import sys
+import timeit
+
+lambda_dir = sys.argv[1] if len(sys.argv) > 1 else 'attractions4u-recommender'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', lambda_dir))
+import text_norm  # noqa: E402
+
+
+NOUN_TAGS = {'NN', 'NNS', 'NNPS', 'NNP'}
+INFLECT = inflect.engine()
+
+
+# attractions4u-recommender/lambda_function.py
+def proc_attraction_type(t: str):
+    if 'nature_reserves' in t:
+        t = 'nature_reserves'
+    t = t.replace('accomodation', 'accommodation')
+
+    res_tokens = []
+    for token, tag in nltk.pos_tag(t.split('_')):
+        if tag in NOUN_TAGS:
+            singular = INFLECT.singular_noun(token)
+            if singular:
+                if singular == 'biergarten':
+                    singular += ' beer garden'
+                res_tokens.append(singular)
+            else:
+                res_tokens.append(token)
+        else:
+            res_tokens.append(token)
+    return ' '.join(res_tokens)
+
+
+# attractions4u-attraction-py/lambda_function.py
+def proc_usr_query(query_str: str):
+    res_tokens = []
+    for token, tag in nltk.pos_tag(query_str.replace('_', ' ').translate(str.maketrans('', '', string.punctuation)).split()):
+        if tag in NOUN_TAGS:
+            singular = INFLECT.singular_noun(token)
+            if singular:
+                res_tokens.append(singular)
+            else:
+                res_tokens.append(token)
+        else:
+            res_tokens.append(token)
+    return ' '.join(res_tokens)
+
+
+def bench(name, func, inputs, repeat=5):
+    # Memoized functions start every repeat with an empty memo
+    clear = getattr(func, 'cache_clear', lambda: None)
+    best = min(timeit.repeat(lambda: [func(x) for x in inputs], setup=clear, number=1, repeat=repeat))
+    print(f'{name:<32} {best * 1000:9.2f} ms  {best / len(inputs) * 1e6:8.2f} us/call')
+    return best
+
+
+def check(name, original, func, inputs):
+    mismatches = [(x, original(x), func(x)) for x in sorted(set(inputs)) if original(x) != func(x)]
+    print(f'{len(mismatches)} {name} mismatches {mismatches[:5]}')
+
+
+def main():
+    random.seed(0)
+    vocab = text_norm.load_vocab()
+    tokens = sorted({token for t in vocab for token in text_norm.attraction_type_tokens(t)})
+    # Batch refresh workload: every profile lists a handful of types from the fixed vocabulary
+    types = [random.choice(vocab) for _ in range(5000)]
+    # Types missing from the vocabulary go through the token table, made of vocabulary tokens in new combinations
+    unknown_types = ['_'.join(random.sample(tokens, random.randint(1, 3))) for _ in range(2000)]
+    unknown_types = [t for t in unknown_types if t not in vocab]
+    # Search workload: free text, partly repeated, some of it made of vocabulary tokens
+    queries = [random.choice(['museums', 'art galleries', 'parks in NYC', 'old churches', 'beaches!', 'Rock climbing'])
+               + random.choice(['', ' near me', ' and cafes']) for _ in range(2000)]
+    queries += [' '.join(random.sample(tokens, random.randint(1, 4))) for _ in range(1000)]
+
+    check('attraction type', proc_attraction_type, text_norm.proc_attraction_type, types + unknown_types)
+    check('user query', proc_usr_query, text_norm.proc_usr_query, queries)
+
+    for name, inputs in (('vocabulary types', types), ('unknown types', unknown_types)):
+        print(f'{name} ({len(inputs)} calls, {len(set(inputs))} distinct)')
+        base = bench('  original (pos_tag per call)', proc_attraction_type, inputs)
+        new = bench('  text_norm', text_norm.proc_attraction_type, inputs)
+        print(f'  speedup x{base / new:.1f}')
+
+    print(f'user queries ({len(queries)} calls, {len(set(queries))} distinct)')
+    base = bench('  original (pos_tag per call)', proc_usr_query, queries)
+    new = bench('  text_norm', text_norm.proc_usr_query, queries)
+    print(f'  speedup x{base / new:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from featurelib.topk import similarity, top_k
+
+
+# Helpers to refresh embeddings and neighbour lists only for attractions that were added or changed.
+# A manifest maps attraction IDs to the content hash their embedding was computed from.
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def diff_manifest(old, new):
+    # IDs that are new or whose content changed, and IDs that are gone
+    changed = [aid for aid, h in new.items() if old.get(aid) != h]
+    removed = [aid for aid in old if aid not in new]
+    return changed, removed
+
+
+def load_neighbours(path):
+    # Reads the "<id>:<id>,<id>,..." files written by the feature scripts
+    lists = {}
+    if not os.path.exists(path):
+        return lists
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            aid, neighbours = line.split(':', 1)
+            lists[aid] = [n for n in neighbours.split(',') if n]
+    return lists
+
+
+def write_neighbours(path, lists, ids=None):
+    with open(path, 'w') as f:
+        for aid in (ids if ids is not None else lists):
+            f.write(f"{aid}:{','.join(lists[aid])}\n")
+
+
+def update_neighbours(ids, vecs, old_lists, changed, removed, k, metric='cosine'):
+    # Returns the new neighbour lists of the affected attractions only:
+    # - the changed or new attractions themselves
+    # - attractions whose old list contains a changed or removed attraction
+    # - attractions for which a changed or new attraction is now closer than their current k-th neighbour
+    row_of = {aid: i for i, aid in enumerate(ids)}
+    changed = [aid for aid in changed if aid in row_of]
+    touched = set(changed) | set(removed)
+
+    affected = set(row_of[aid] for aid in changed)
+    for aid, neighbours in old_lists.items():
+        if aid in row_of and (len(neighbours) < min(k, len(ids) - 1) or touched.intersection(neighbours)):
+            affected.add(row_of[aid])
+
+    if len(changed):
+        changed_rows = np.asarray([row_of[aid] for aid in changed])
+        rest = np.asarray([i for i, aid in enumerate(ids) if i not in affected and aid in old_lists])
+        if len(rest):
+            # Similarity of every other attraction to its current k-th neighbour and to the changed ones
+            last = np.asarray([row_of[old_lists[ids[i]][-1]] for i in rest])
+            if metric == 'cosine':
+                kth = (vecs[rest] * vecs[last]).sum(1)
+            else:
+                kth = -((vecs[rest] - vecs[last]) ** 2).sum(1)
+            best_changed = similarity(vecs[rest], vecs[changed_rows], metric).max(1)
+            affected.update(int(i) for i in rest[best_changed > kth])
+        # Attractions that never had a list
+        affected.update(i for i, aid in enumerate(ids) if aid not in old_lists)
+
+    rows = sorted(affected)
+    top, _ = top_k(vecs, k, metric, rows=rows)
+    return {ids[row]: [ids[i] for i in neighbours] for row, neighbours in zip(rows, top)}
+
+
+def apply_update(ids, old_lists, updates):
+    # Full set of lists for the current IDs after applying the updates
+    return {aid: updates.get(aid, old_lists.get(aid, [])) for aid in ids}
@@ -0,0 +1,65 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Row-blocked top-k similarity search. Only a (block_rows, N) float32 score matrix exists at
+# a time, and the top k of each row is selected with argpartition instead of a full sort.
+
+_worker_state = {}
+
+
+def similarity(query, vecs, metric='cosine'):
+    # Higher is more similar. Vectors must already be L2-normalized for 'cosine'.
+    if metric == 'cosine':
+        return query @ vecs.T
+    # Negated squared euclidean distance, same ranking as sklearn's NearestNeighbors
+    return 2 * (query @ vecs.T) - (query ** 2).sum(1)[:, None] - (vecs ** 2).sum(1)[None, :]
+
+
+def top_k_block(vecs, rows, k, metric='cosine', exclude_self=True):
+    scores = similarity(vecs[rows], vecs, metric)
+    if exclude_self:
+        scores[np.arange(len(rows)), rows] = -np.inf
+    k = min(k, scores.shape[1] - (1 if exclude_self else 0))
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def _init_worker(vecs, metric, exclude_self):
+    _worker_state['vecs'] = vecs
+    _worker_state['metric'] = metric
+    _worker_state['exclude_self'] = exclude_self
+
+
+def _worker_block(args):
+    rows, k = args
+    s = _worker_state
+    return top_k_block(s['vecs'], rows, k, s['metric'], s['exclude_self'])
+
+
+def top_k(vecs, k, metric='cosine', rows=None, block_rows=1024, workers=1, exclude_self=True):
+    # Indices (len(rows), k) of the k most similar rows of vecs for each of the given rows
+    # (all rows by default), sorted by decreasing similarity, and their scores
+    vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+    rows = np.arange(len(vecs)) if rows is None else np.asarray(rows, dtype=np.int64)
+    blocks = [(rows[i:i + block_rows], k) for i in range(0, len(rows), block_rows)]
+    if not len(blocks):
+        return np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(vecs, metric, exclude_self)) as pool:
+            results = list(pool.map(_worker_block, blocks))
+    else:
+        results = [top_k_block(vecs, block, bk, metric, exclude_self) for block, bk in blocks]
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def normalize(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vecs / norms
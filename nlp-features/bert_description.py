@@ -2,75 +2,204 @@
 """bert_description.ipynb
 
 Automatically generated by Colaboratory.
+
+Embeds attraction descriptions with BERT in length-bucketed, dynamically padded batches and
+streams the pooler outputs to sharded .npy files under --out-dir. A checkpoint lists the
+finished shards, so an interrupted run resumes where it stopped and a later run only embeds
+attractions that have no embedding yet. With --incremental, attractions whose description
+changed are re-embedded too, and only the affected neighbour lists are recomputed.
 """
 
-import os
+import argparse
 import json
-from time import sleep
-from pprint import pprint
-
-inp_file = 'raw.json'
-out_file = 'description.json'
-with open(inp_file) as f:
-    data = json.load(f)['Items']
-    
-description = []
-ids = []
-max_lenght = 0
-for item in data:
-    aid = item['attractionId']['S']
-
-    raw_attraction_types = item['attractionType']['S']
-
-    raw_desc = raw_attraction_types+'. '+item['description']['S']
-    max_lenght = max(max_lenght, len(raw_desc.split()))
-    description.append(raw_desc)
-    ids.append(aid)
-print(max_lenght)
-
-print(len(description))
-
-from transformers import AutoTokenizer
+import os
+import sys
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoModel, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from featurelib.incremental import (  # noqa: E402
+    apply_update, content_hash, diff_manifest, load_manifest, load_neighbours, save_manifest,
+    update_neighbours, write_neighbours
+)
+from featurelib.topk import top_k  # noqa: E402
+
+
 model_name = "bert-base-uncased"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+max_length = 256
+CHECKPOINT_FILE = 'checkpoint.json'
+MANIFEST_FILE = 'manifest.json'
 
-from transformers import AutoModel
-pt_model = AutoModel.from_pretrained(model_name)
 
-from tqdm import tqdm
-embeddings=[]
-
-for value in tqdm(description):
-  pt_batch = tokenizer(
-    value,
-    padding=True,
-    truncation=True,
-    max_length=256,
-    return_tensors="pt",
-  )
-  pt_outputs = pt_model(**pt_batch)
-  embedding = pt_outputs.pooler_output.squeeze()
-  embeddings.append(embedding.tolist())
-
-from sklearn.neighbors import NearestNeighbors
-import numpy as np
-embeddings = np.array(embeddings)
-nbrs = NearestNeighbors(n_neighbors=10, algorithm='ball_tree').fit(embeddings)
-distances, indices = nbrs.kneighbors(embeddings)
-
-print(indices[0])
-
-L = []
-for item in indices:
-  s = ids[item[0]] + ':'
-  for idx in item[1:-1]:
-    s+= ids[idx] + ','
-  s+= ids[item[-1]]+' \n'
-  L.append(s)
-
-for att in indices[0]:
-  print(description[att])
-
-file1 = open("description_similarity.txt","w")
-file1.writelines(L)
-file1.close()
+def load_descriptions(inp_file):
+    with open(inp_file) as f:
+        data = json.load(f)['Items']
+
+    description = []
+    ids = []
+    for item in data:
+        aid = item['attractionId']['S']
+        raw_attraction_types = item['attractionType']['S']
+        raw_desc = raw_attraction_types + '. ' + item['description']['S']
+        description.append(raw_desc)
+        ids.append(aid)
+    return ids, description
+
+
+def load_checkpoint(out_dir):
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return {'shards': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(out_dir, checkpoint):
+    # Written to a temporary file first so that a crash never leaves a truncated checkpoint
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def embedded_ids(out_dir, checkpoint):
+    done = set()
+    for shard in checkpoint['shards']:
+        with open(os.path.join(out_dir, shard + '.ids.json')) as f:
+            done.update(json.load(f))
+    return done
+
+
+def make_batches(tokenizer, texts, batch_size):
+    # Sorting by token count keeps similar lengths together, so each batch pads to a short max length
+    lengths = [len(ids) for ids in tokenizer(texts, truncation=True, max_length=max_length)['input_ids']]
+    order = np.argsort(lengths, kind='stable')
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def embed(ids, description, out_dir, batch_size=32, shard_size=2048, threads=None, force_ids=()):
+    if threads:
+        torch.set_num_threads(threads)
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint = load_checkpoint(out_dir)
+    # Embeddings of changed attractions are overridden by the newer shards
+    done = embedded_ids(out_dir, checkpoint) - set(force_ids)
+    todo = [i for i, aid in enumerate(ids) if aid not in done]
+    print(f'{len(done)} already embedded, {len(todo)} to embed')
+    if not len(todo):
+        return
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    pt_model = AutoModel.from_pretrained(model_name)
+    pt_model.eval()
+
+    texts = [description[i] for i in todo]
+    batches = make_batches(tokenizer, texts, batch_size)
+    shard_vecs, shard_ids = [], []
+
+    def flush_shard():
+        name = f'shard_{len(checkpoint["shards"]):05d}'
+        np.save(os.path.join(out_dir, name + '.npy'), np.concatenate(shard_vecs, axis=0))
+        with open(os.path.join(out_dir, name + '.ids.json'), 'w') as f:
+            json.dump(shard_ids, f)
+        checkpoint['shards'].append(name)
+        save_checkpoint(out_dir, checkpoint)
+        shard_vecs.clear()
+        shard_ids.clear()
+
+    with torch.inference_mode():
+        for batch in tqdm(batches):
+            pt_batch = tokenizer(
+                [texts[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=max_length,
+                return_tensors="pt",
+            )
+            pt_outputs = pt_model(**pt_batch)
+            shard_vecs.append(pt_outputs.pooler_output.float().numpy())
+            shard_ids.extend(ids[todo[i]] for i in batch)
+            if len(shard_ids) >= shard_size:
+                flush_shard()
+    if len(shard_ids):
+        flush_shard()
+
+
+def load_embeddings(out_dir, ids):
+    # Embeddings of the given attractions, in the given order
+    rows = {}
+    for shard in load_checkpoint(out_dir)['shards']:
+        vecs = np.load(os.path.join(out_dir, shard + '.npy'), mmap_mode='r')
+        with open(os.path.join(out_dir, shard + '.ids.json')) as f:
+            for aid, vec in zip(json.load(f), vecs):
+                rows[aid] = vec
+    return np.stack([rows[aid] for aid in ids]).astype(np.float32)
+
+
+def write_similarity(ids, embeddings, out_file, n_neighbors=10, workers=1):
+    # Euclidean nearest neighbours like the former ball tree, without the attraction itself
+    indices, _ = top_k(embeddings, n_neighbors - 1, metric='euclidean', workers=workers)
+
+    L = []
+    for i, item in enumerate(indices):
+        s = ids[i] + ':'
+        for idx in item[:-1]:
+            s += ids[idx] + ','
+        s += ids[item[-1]] + ' \n'
+        L.append(s)
+
+    with open(out_file, "w") as file1:
+        file1.writelines(L)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inp-file', default='raw.json')
+    parser.add_argument('--out-dir', default='embeddings')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--shard-size', type=int, default=2048, help='rows per output shard')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads')
+    parser.add_argument('--similarity-file', default='description_similarity.txt')
+    parser.add_argument('--workers', type=int, default=1, help='processes computing the neighbour lists')
+    parser.add_argument('--incremental', action='store_true',
+                        help='re-embed changed descriptions and only update the affected neighbour lists')
+    parser.add_argument('--delta-file', default='description_similarity_delta.txt',
+                        help='changed neighbour lists, written in incremental mode for upload')
+    args = parser.parse_args()
+
+    ids, description = load_descriptions(args.inp_file)
+    print(len(description))
+
+    manifest_path = os.path.join(args.out_dir, MANIFEST_FILE)
+    manifest = {aid: content_hash(desc) for aid, desc in zip(ids, description)}
+    old_manifest = load_manifest(manifest_path)
+    changed, removed = diff_manifest(old_manifest, manifest)
+    print(f'{len(changed)} new or changed, {len(removed)} removed descriptions')
+    # Changed descriptions are always re-embedded, the manifest saved below records them as up to date.
+    # Without a previous manifest there is nothing to tell changed descriptions apart, keep existing shards.
+    force_ids = changed if len(old_manifest) else ()
+    embed(ids, description, args.out_dir, args.batch_size, args.shard_size, args.threads, force_ids)
+
+    embeddings = load_embeddings(args.out_dir, ids)
+    # Consolidated copy for ann_index.py and the other offline tools
+    np.save(os.path.join(args.out_dir, 'embeddings.npy'), embeddings)
+    with open(os.path.join(args.out_dir, 'ids.txt'), 'w') as f:
+        f.writelines(aid + '\n' for aid in ids)
+
+    old_lists = load_neighbours(args.similarity_file)
+    if args.incremental and len(old_lists):
+        # Same ranking as the ball tree: euclidean distance between the raw pooler outputs
+        updates = update_neighbours(ids, embeddings, old_lists, changed, removed, k=9, metric='euclidean')
+        write_neighbours(args.delta_file, updates)
+        write_neighbours(args.similarity_file, apply_update(ids, old_lists, updates), ids)
+        print(f'{len(updates)} neighbour lists updated')
+    else:
+        write_similarity(ids, embeddings, args.similarity_file, workers=args.workers)
+    save_manifest(manifest_path, manifest)
+
+
+if __name__ == '__main__':
+    main()
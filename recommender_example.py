@@ -11,11 +11,17 @@
 import pandas as pd
 import random
 import json
+import argparse
+import hashlib
+import os
+import pickle
+import socketserver
+import threading
 from sklearn.feature_extraction.text import TfidfVectorizer
 import sklearn
-from sklearn.metrics.pairwise import linear_kernel,cosine_similarity
 import numpy as np
 from sklearn.decomposition import TruncatedSVD
+import scipy.sparse as sp
 import sys
 from rake_nltk import Rake
 import gc
@@ -30,177 +36,439 @@ import gc
 # In[49]:
 
 
-def get_purchase_list(username):
-    purchase_list = []
-    bought_list = df_1["buyer"]
-    
-    for b in df_1["buyer"]:
-        if username in b:
-            item_id = df_1.loc[df_1["buyer"].astype(str) == str(b)]["item_id"].array
-            purchase_list.append(item_id[0])           
-            
-    return purchase_list
+def build_interactions(items):
+    # Tidy tables from the item records, built with explode and merge instead of per-row loops:
+    # - df_1: one row per item
+    # - purchases: one row per (item_id, buyer) from the comma separated buyer strings
+    # - ratings: one row per (item_id, buyer, rating) for comments written by a buyer of the item
+    # An empty catalogue gives a frame without columns
+    df_1 = pd.DataFrame(items) if len(items) else pd.DataFrame(columns=['item_id'])
+    for col, default in (('description', ''), ('comments', None), ('buyer', '')):
+        if col not in df_1:
+            df_1[col] = default
+    df_1['item_id'] = df_1['item_id'].astype(str)
 
-    
-def get_index(purchase_list):
-    return random.randint(0,len(purchase_list)-1)
+    purchases = df_1[['item_id']].assign(buyer=df_1['buyer'].fillna('').astype(str).str.split(',')).explode('buyer')
+    purchases = purchases[purchases['buyer'] != ''].drop_duplicates().reset_index(drop=True)
+
+    comments = df_1[['item_id', 'comments']].explode('comments').dropna(subset=['comments'])
+    comments = pd.DataFrame(comments['comments'].tolist(), columns=['author', 'rating']) \
+        .rename(columns={'author': 'buyer'}).assign(item_id=comments['item_id'].to_numpy()).dropna()
+    ratings = comments.merge(purchases, on=['item_id', 'buyer'])[['item_id', 'buyer', 'rating']]
+    return df_1.drop(columns=['comments']), purchases, ratings
+
+
+def build_purchase_index(purchases):
+    # buyer -> item IDs in catalogue order, so a user's purchases are a dict lookup
+    item_ids = purchases['item_id'].to_numpy()
+    return {buyer: item_ids[rows] for buyer, rows in purchases.groupby('buyer').indices.items()}
+
+
+def get_purchase_list(username, purchase_index):
+    return list(purchase_index.get(username, ()))
+
+
+def build_rating_index(ratings):
+    # buyer -> {item_id: rating}, repeated ratings of an item averaged
+    mean = ratings.groupby(['buyer', 'item_id'])['rating'].mean()
+    index = {}
+    for (buyer, item_id), rating in mean.items():
+        index.setdefault(buyer, {})[item_id] = float(rating)
+    return index
 
 
 # In[57]:
 
 
-def recommend(item_id, num,df_1):
-    item_id = str(item_id)
-    tf = TfidfVectorizer(analyzer='word', ngram_range=(1, 4), min_df=0, stop_words='english')
-    df_1['key_words'] = ''
-    r = Rake() 
-    for index, row in df_1.iterrows():
-        r.extract_keywords_from_text(row['description'])
-        key_words_dict_scores = r.get_word_degrees()
-        row['key_words'] = list(key_words_dict_scores.keys())
-    columns = ['key_words'] 
-    for index, row in df_1.iterrows():
-        words = ''
-        for col in columns:
-            words += ' '.join(row[col]) + ' '
-        row['description'] = words
-    tfidf_matrix = tf.fit_transform(df_1['description'])
-    cosine_similarities = cosine_similarity(tfidf_matrix, tfidf_matrix)
-    results = {}
-    for index, row in df_1.iterrows():        
-        similar_index = cosine_similarities[index].argsort()
-        similar_items = [(cosine_similarities[index][i], df_1['item_id'][i]) for i in similar_index]
-        results[row['item_id']] = similar_items[1:]
-#     print(item_id)
-    recs = results[item_id][:num]
-    rec_list = []
-    for rec in recs:
-        rec_list.append(rec[1]) 
-    return rec_list
+# Fitted models are pickled here and reused while the catalogue they were fitted on doesn't change
+MODEL_DIR = os.environ.get('RECOMMENDER_MODEL_DIR', 'models')
+_models = {}
+
+
+def catalogue_key(df, columns):
+    h = hashlib.sha1()
+    for col in columns:
+        h.update('\x1f'.join(df[col].astype(str)).encode('utf8'))
+        h.update(b'\x1e')
+    return h.hexdigest()[:16]
+
+
+def load_or_fit(name, key, fit):
+    # In-process first, then the pickle from an earlier run, else fit and persist
+    cached = _models.get(name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    path = os.path.join(MODEL_DIR, f'{name}-{key}.pkl')
+    model = None
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+        except Exception:
+            model = None
+    if model is None:
+        model = fit()
+        try:
+            os.makedirs(MODEL_DIR, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            # Models of older catalogues are never loaded again
+            for old in os.listdir(MODEL_DIR):
+                if old.startswith(name + '-') and old.endswith('.pkl') and old != os.path.basename(path):
+                    os.remove(os.path.join(MODEL_DIR, old))
+        except OSError:
+            pass
+    _models[name] = (key, model)
+    return model
+
+
+# Seeds scored per matrix multiply in batch requests, bounds the dense (seeds x items) score block
+BATCH_BLOCK_SEEDS = int(os.environ.get('RECOMMENDER_BATCH_BLOCK_SEEDS', '1024'))
+
+
+def top_n_rows(scores, num):
+    # Per row, indices of the num highest finite scores, best first
+    num = min(num, scores.shape[1])
+    if num <= 0:
+        return [[] for _ in range(len(scores))]
+    top = np.argpartition(-scores, num - 1, axis=1)[:, :num]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    finite = np.isfinite(np.take_along_axis(top_scores, order, axis=1))
+    return [row[ok] for row, ok in zip(top, finite)]
+
+
+def weight_matrix(rows, profiles):
+    # Sparse (profiles x model items) matrix of item weights, items the model doesn't know are left out
+    data, indices, indptr = [], [], [0]
+    for profile in profiles:
+        for aid, w in profile.items():
+            row = rows.get(str(aid))
+            if row is not None:
+                indices.append(row)
+                data.append(float(w))
+        indptr.append(len(indices))
+    return sp.csr_matrix((data, indices, indptr), shape=(len(profiles), len(rows)))
+
+
+def similar_batch(item_ids, rows, profiles, num, score_block):
+    # Top num items for every profile, a {item_id: weight} dict of the items it is made of, best first.
+    # score_block(W) returns the (len(W), items) scores of a block of the weight matrix with -inf for
+    # excluded items. The profile's own items are never returned.
+    W = weight_matrix(rows, profiles)
+    res = [[] for _ in profiles]
+    known = np.flatnonzero(np.diff(W.indptr) > 0)
+    for start in range(0, len(known), BATCH_BLOCK_SEEDS):
+        block = known[start:start + BATCH_BLOCK_SEEDS]
+        W_block = W[block]
+        scores = score_block(W_block)
+        scores[W_block.nonzero()] = -np.inf
+        for i, top in zip(block, top_n_rows(scores, num)):
+            res[i] = [item_ids[j] for j in top]
+    return res
+
+
+def extract_keywords(descriptions):
+    # RAKE's word degrees have a key for every lowercased word token that is neither a stopword nor
+    # punctuation, so the whole catalogue is tokenized and filtered in one pass instead of running Rake per row
+    ignore = Rake().to_ignore
+    words = descriptions.fillna('').astype(str).str.lower().str.findall(r'\w+|[^\w\s]+').explode().dropna()
+    words = words[~words.isin(ignore)]
+    # First occurrence of each word per item, in text order like the word degree dict
+    words = words[~pd.MultiIndex.from_arrays([words.index, words.values]).duplicated()]
+    return words.groupby(level=0).agg(' '.join).reindex(descriptions.index, fill_value='')
+
+
+class ContentModel:
+    # TF-IDF of the item keywords. Rows are L2-normalized, so a sparse dot product is the cosine similarity.
+
+    def __init__(self, item_ids, vectorizer, matrix):
+        self.item_ids = list(item_ids)
+        self.rows = {aid: i for i, aid in enumerate(self.item_ids)}
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+
+    @classmethod
+    def fit(cls, df):
+        tf = TfidfVectorizer(analyzer='word', ngram_range=(1, 4), min_df=1, stop_words='english')
+        matrix = tf.fit_transform(extract_keywords(df['description']))
+        return cls(df['item_id'].astype(str), tf, matrix.tocsr())
+
+    def updated(self, df, changed_ids):
+        # New or changed descriptions are transformed with the fitted vocabulary and IDF,
+        # the rows of the other items are reused
+        item_ids = df['item_id'].astype(str)
+        changed = item_ids.isin(set(changed_ids)).to_numpy() | ~item_ids.isin(self.rows).to_numpy()
+        kept_rows = [self.rows[aid] for aid in item_ids[~changed]]
+        new_rows = self.vectorizer.transform(extract_keywords(df['description'][changed]))
+        stacked = sp.vstack([self.matrix[kept_rows], new_rows]).tocsr()
+        # Back to catalogue order
+        order = np.empty(len(item_ids), dtype=np.int64)
+        order[np.flatnonzero(~changed)] = np.arange(len(kept_rows))
+        order[np.flatnonzero(changed)] = len(kept_rows) + np.arange(int(changed.sum()))
+        return ContentModel(item_ids, self.vectorizer, stacked[order])
+
+    def similar_batch(self, profiles, num):
+        # Only the profile centroids are scored against the catalogue, one sparse product per block of profiles.
+        # Scaling a centroid doesn't change its ranking, so it isn't normalized.
+        return similar_batch(self.item_ids, self.rows, profiles, num,
+                             lambda W: ((W @ self.matrix) @ self.matrix.T).toarray())
+
+    def similar(self, item_id, num):
+        return self.similar_batch([{item_id: 1.0}], num)[0]
+
+
+def content_model(df_1):
+    key = catalogue_key(df_1, ['item_id', 'description'])
+    return load_or_fit('content', key, lambda: ContentModel.fit(df_1))
+
+
+def recommend(item_id, num, df_1):
+    return content_model(df_1).similar(item_id, num)
 
 
 # In[4]:
 
 
-def col_fil(item_index,num,final_ver_df):    
-    final_ver_df.sort_values("rating",ascending=False)
-    ratings_utility_matrix = final_ver_df.pivot_table(values='rating', index= "buyer", columns='item_id', fill_value=0)
-    X = ratings_utility_matrix.T
-    X1 = X
-    
-    SVD = TruncatedSVD(n_components=3)
-    decomposed_matrix = SVD.fit_transform(X)
-    correlation_matrix = np.corrcoef(decomposed_matrix)
-    X.index[item_index]
-    product_names = list(X.index)
-    product_ID = product_names.index(X.index[item_index])
-    correlation_product_ID = correlation_matrix[product_ID]
-    Recommend = list(X.index[correlation_product_ID > 0.80])
-    Recommend.remove(X.index[item_index]) 
-    return Recommend[0:num]
+class CFModel:
+    # TruncatedSVD factors of the sparse item x buyer ratings matrix. Each item's factors are centered and
+    # normalized, so the dot product of two rows is the Pearson correlation np.corrcoef gave over the factors.
+
+    def __init__(self, item_ids, buyers, svd, factors):
+        self.item_ids = list(item_ids)
+        self.rows = {aid: i for i, aid in enumerate(self.item_ids)}
+        self.buyers = buyers
+        self.svd = svd
+        self.factors = factors
+
+    @staticmethod
+    def correlation_rows(decomposed):
+        centered = decomposed - decomposed.mean(1, keepdims=True)
+        norms = np.linalg.norm(centered, axis=1, keepdims=True)
+        # Items with constant factors correlate with nothing, like the NaN rows of corrcoef
+        norms[norms == 0] = np.inf
+        return (centered / norms).astype(np.float32)
+
+    @staticmethod
+    def ratings_matrix(final_ver_df, buyers=None):
+        # Repeated ratings of an item by the same buyer are averaged like pivot_table did.
+        # With given buyers (the columns of a fitted model) ratings by anyone else are left out.
+        ratings = final_ver_df.assign(item_id=final_ver_df['item_id'].astype(str)) \
+            .groupby(['item_id', 'buyer'], as_index=False)['rating'].mean()
+        item_ids = pd.Index(ratings['item_id'].unique()).sort_values()
+        if buyers is None:
+            buyers = pd.Index(ratings['buyer'].unique()).sort_values()
+        cols = buyers.get_indexer(ratings['buyer'])
+        known = cols >= 0
+        X = sp.csr_matrix(
+            (ratings['rating'].to_numpy(np.float64)[known], (item_ids.get_indexer(ratings['item_id'])[known], cols[known])),
+            shape=(len(item_ids), len(buyers))
+        )
+        return item_ids, buyers, X, int((~known).sum())
+
+    @classmethod
+    def fit(cls, final_ver_df, n_components=3):
+        item_ids, buyers, X, _ = cls.ratings_matrix(final_ver_df)
+        if n_components >= X.shape[1]:
+            raise ValueError(f'{X.shape[1]} buyers, at least {n_components + 1} are needed for {n_components} components')
+        svd = TruncatedSVD(n_components=n_components)
+        decomposed = svd.fit_transform(X)
+        return cls(item_ids, buyers, svd, cls.correlation_rows(decomposed))
+
+    def folded_in(self, final_ver_df):
+        # Item factors of new ratings projected onto the fitted components, no refit.
+        # Also returns how many ratings were left out because their buyer is not a column of the model.
+        item_ids, _, X, unseen = self.ratings_matrix(final_ver_df, self.buyers)
+        return CFModel(item_ids, self.buyers, self.svd, self.correlation_rows(self.svd.transform(X))), unseen
+
+    def similar_batch(self, profiles, num, threshold=0.80):
+        # Only the profile centroids are correlated with the items
+        def score_block(W):
+            corr = self.correlation_rows(W @ self.factors) @ self.factors.T
+            corr[corr <= threshold] = -np.inf
+            return corr
+        return similar_batch(self.item_ids, self.rows, profiles, num, score_block)
+
+    def similar(self, item_id, num, threshold=0.80):
+        return self.similar_batch([{item_id: 1.0}], num, threshold)[0]
+
+
+def cf_model(final_ver_df):
+    key = catalogue_key(final_ver_df, ['item_id', 'buyer', 'rating'])
+    return load_or_fit('cf', key, lambda: CFModel.fit(final_ver_df))
+
+
+def col_fil(item_id, num, final_ver_df):
+    return cf_model(final_ver_df).similar(item_id, num)
+
+
+# Share of the catalogue (new or changed descriptions) or of the ratings (by buyers the SVD has no column for)
+# that incremental updates may cover before the model is fitted again
+REFIT_FRACTION = float(os.environ.get('RECOMMENDER_REFIT_FRACTION', '0.2'))
+
+
+class RecommenderState:
+    # Fitted models and lookup tables of the current catalogue, kept across requests by the worker modes
+
+    def __init__(self):
+        self.df_1 = None
+        self.descriptions = {}
+        self.purchase_index = {}
+        self.rating_index = {}
+        self.final_ver_df = None
+        self.content = None
+        self.cf = None
+        self.content_drift = 0
+        self.cf_unseen = 0
+
+    def update(self, items):
+        # Everything is built before anything is replaced, a failed update leaves the previous catalogue serving
+        df_1, purchases, final_ver_df = build_interactions(items)
+        purchase_index = build_purchase_index(purchases)
+        rating_index = build_rating_index(final_ver_df)
+        content, content_drift = self.updated_content(df_1)
+        cf, cf_unseen = self.updated_cf(final_ver_df)
+        self.df_1, self.final_ver_df = df_1, final_ver_df
+        self.descriptions = dict(zip(df_1['item_id'], df_1['description']))
+        self.purchase_index, self.rating_index = purchase_index, rating_index
+        self.content, self.content_drift = content, content_drift
+        self.cf, self.cf_unseen = cf, cf_unseen
+
+    def updated_content(self, df_1):
+        # Content model of the new catalogue and the drift since it was fitted
+        if not len(df_1):
+            return None, 0
+        changed = df_1['item_id'][df_1['item_id'].map(self.descriptions) != df_1['description']]
+        removed = len(set(self.descriptions) - set(df_1['item_id']))
+        if self.content is not None and not len(changed) and not removed:
+            return self.content, self.content_drift
+        drift = self.content_drift + len(changed) + removed
+        if self.content is None or drift > REFIT_FRACTION * len(df_1):
+            return content_model(df_1), 0
+        return self.content.updated(df_1, changed), drift
+
+    def updated_cf(self, final_ver_df):
+        # CF model of the new ratings and how many of them it left out
+        if self.final_ver_df is not None and final_ver_df.equals(self.final_ver_df):
+            return self.cf, self.cf_unseen
+        if not len(final_ver_df):
+            return None, 0
+        cf, unseen = None, 0
+        if self.cf is not None:
+            cf, unseen = self.cf.folded_in(final_ver_df)
+        if cf is None or unseen > REFIT_FRACTION * len(final_ver_df):
+            try:
+                return cf_model(final_ver_df), 0
+            except ValueError:
+                # Too few buyers for the SVD, collaborative filtering is skipped
+                return None, 0
+        return cf, unseen
+
+    def user_profile(self, username):
+        # All purchases weighted by the user's rating, unrated ones by the user's average rating
+        ratings = self.rating_index.get(username, {})
+        default = float(np.mean(list(ratings.values()))) if len(ratings) else 1.0
+        return {aid: ratings.get(aid, default) for aid in get_purchase_list(username, self.purchase_index)}
+
+    def recommend_batch(self, usernames, num=3):
+        # Profiles of all users are scored together, one matrix product per block of profiles and model
+        profiles = [self.user_profile(username) for username in usernames]
+        buyers = [i for i, profile in enumerate(profiles) if len(profile) > 0]
+        buyer_profiles = [profiles[i] for i in buyers]
+        content_res = dict(zip(buyers, self.content.similar_batch(buyer_profiles, num))) \
+            if self.content is not None else {}
+        cf_res = dict(zip(buyers, self.cf.similar_batch(buyer_profiles, num))) if self.cf is not None else {}
+
+        item_ids = list(self.df_1['item_id'])
+        results = {}
+        for i, username in enumerate(usernames):
+            final_res = []
+            for item_id in content_res.get(i, []) + cf_res.get(i, []):
+                if item_id not in final_res:
+                    final_res.append(item_id)
+            if len(final_res) == 0:
+                # Random items for users without purchases or without any similar item
+                final_res = random.sample(item_ids, min(num, len(item_ids)))
+            results[username] = final_res
+        return results
+
+    def recommend(self, username, num=3):
+        return self.recommend_batch([username], num)[username]
+
+
+def handle_request(state, req):
+    # {"items": [...]} replaces the catalogue, {"username": ...} asks for one user's recommendations
+    # and {"usernames": [...]} for a {username: recommendations} map, items can be combined with either
+    if 'items' in req:
+        state.update(req['items'])
+    if 'username' in req or 'usernames' in req:
+        if state.df_1 is None:
+            return {'error': 'no catalogue loaded'}
+        if 'usernames' in req:
+            return state.recommend_batch(req['usernames'], req.get('num', 3))
+        return state.recommend(req['username'], req.get('num', 3))
+    return {'ok': True, 'items': 0 if state.df_1 is None else len(state.df_1)}
+
+
+def handle_line(state, line):
+    try:
+        return handle_request(state, json.loads(line))
+    except Exception as e:
+        return {'error': repr(e)}
+
+
+def serve_stdin(state):
+    # One JSON request per input line, one JSON response per output line
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        print(json.dumps(handle_line(state, line)))
+        sys.stdout.flush()
+
+
+def serve_socket(state, path):
+    lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                with lock:
+                    res = handle_line(state, line)
+                self.wfile.write((json.dumps(res) + '\n').encode('utf8'))
+
+    if os.path.exists(path):
+        os.remove(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        print(f'[INFO] serving on {path}', file=sys.stderr)
+        server.serve_forever()
 
 
 # In[68]:
 
 
 if __name__ == "__main__":
-    obj = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('request', nargs='?',
+                        help='JSON request with "items" and "username" or "usernames", - reads it from stdin')
+    parser.add_argument('--serve', action='store_true', help='keep running, one JSON request per stdin line')
+    parser.add_argument('--socket', help='keep running, serving JSON line requests on this unix socket')
+    args = parser.parse_args()
+
+    state = RecommenderState()
+    if args.socket:
+        serve_socket(state, args.socket)
+    elif args.serve:
+        serve_stdin(state)
+    else:
+        obj = sys.stdin.read() if args.request in (None, '-') else args.request
 
 #     obj = '{"username":"TooLazy","items":[{"item_id":"0","description":"It is spongebob. It belongs to category home. Product insurance . Detaching Info . Care Instruction . Description on damages ","comments":[],"buyer":"TooLazy,Buyer1"},{"item_id":"1","description":"It is sofa2. It belongs to category home. Product insurance NO insurance. Detaching Info dvdvdvddcdddddddddddddddddddddddddddddddddddddddddddddddddddd. Care Instruction ccccccccccccccccccccccccccccccccccccc. Description on damages Perfect. No damage","comments":[{"rating":3,"author":"TooLazy"},{"rating":7,"author":"Buyer11"}],"buyer":""},{"item_id":"3","description":"It is Genki textbook. It belongs to category books. Product insurance no insurance. Detaching Info not detachable. Care Instruction just a book. Description on damages almost perfect, some notes being taken","comments":[{"rating":9,"author":"TooLazy"}],"buyer":""},{"item_id":"4","description":"It is Harry Potter and the Sorcerers Stone. It belongs to category books. Product insurance no insurance. Detaching Info not detachable. Care Instruction just a book. Description on damages perfect, no damage","comments":[],"buyer":""},{"item_id":"7","description":"It is iclicker. It belongs to category electronics. Product insurance no insurance. Detaching Info . Care Instruction no batteries included, need to plugin batteries yourself. Description on damages there are light scratches but the item is totally functional","comments":[],"buyer":""},{"item_id":"8","description":"It is HP laptop. It belongs to category electronics. Product insurance No insurance. Detaching Info . Care Instruction charger is included. Description on damages there are scratches on the bottom, and little issues with the fans","comments":[],"buyer":""},{"item_id":"9","description":"It is Iphone 11, 128GB. It belongs to category electronics. Product insurance No insurance. Detaching Info . Care Instruction no charger/USB included. Description on damages there are some sort of light scratches on the back, otherwise, perfect","comments":[],"buyer":""},{"item_id":"11","description":"It is dog outdoor tent. It belongs to category pets. Product insurance no insurance. Detaching Info detachable. Care Instruction . Description on damages there is a hole on left side","comments":[],"buyer":""},{"item_id":"12","description":"It is outdoor pink bike. It belongs to category motors. Product insurance No insurance. Detaching Info No detaching info. Care Instruction . Description on damages perfect but little scratches on the body","comments":[],"buyer":"TooLazy"},{"item_id":"13","description":"It is bike. It belongs to category motors. Product insurance NO insurance. Detaching Info . Care Instruction . Description on damages ","comments":[{"rating":8,"author":"TooLazy"}],"buyer":""},{"item_id":"15","description":"It is bb-8. It belongs to category home. Product insurance . Detaching Info . Care Instruction . Description on damages ","comments":[],"buyer":"Buyer1,Buyer2"},{"item_id":"16","description":"It is bb-88. It belongs to category home. Product insurance . Detaching Info . Care Instruction . Description on damages ","comments":[],"buyer":""}]}'
-    data = json.dumps(eval(obj))
-    data_list = json.loads(data)
-
-
-    username = data_list["username"]
-    items = data_list["items"]
-#     print(len(items))
-
-    df_1=pd.DataFrame(items)
-
-    all_rate = []
-    all_buyer = []
-    new_buyer = []
-    for b in df_1["buyer"]:
-        if len(b)>0:
-            buyer_list = b.split(',')
-            new_buyer.append(buyer_list)
-        else:
-            new_buyer.append([])  
-
-    index = 0
-    for c in df_1["comments"].array:
-        comment_list = c
-        current_rate = []
-        current_author = []
-        for i in comment_list:
-            if i["author"] in new_buyer[index]:
-                current_rate.append(i["rating"])
-                current_author.append(i["author"])
-        all_rate.append(current_rate)
-        all_buyer.append(current_author)
-        index = index + 1
-
-    df_1["buyer"] = new_buyer
-    df_2 = df_1.drop(columns=["comments"])
-
-    array_display = df_2.to_numpy()
-    new_list = []
-
-    for i in array_display:
-        item = []
-        for j in i:
-            if isinstance(j, list) == False:
-                item.append(j)
-        new_list.append(item)
-
-    final_version = []
-    index = 0
-
-    for i in all_buyer:
-        rating_index = 0
-        for j in i:
-            item = []
-            item = new_list[index].copy()
-            item.append(all_rate[index][rating_index])
-            item.append(j)
-            final_version.append(item)
-            rating_index = rating_index + 1
-        index = index + 1
-
-    final_ver_df = pd.DataFrame(final_version, columns=["item_id", "description","rating","buyer"])
-
-
-    purchase_list = get_purchase_list(username)
-    final_res = []
-    if len(purchase_list) > 0:
-#         print(purchase_list)
-        content_based_res = []
-        col_fil_res = []
-        content_based_index = get_index(purchase_list)
-#         print(purchase_list)
-        content_based_res = recommend(purchase_list[content_based_index], 3,df_1)
-
-        try:
-            col_fil_index = get_index(purchase_list)
-            col_fil_res = col_fil(purchase_list[col_fil_index],3,final_ver_df)
-        except Exception:
-            pass
+        final_res = handle_request(state, json.loads(obj))
 
-#         print(content_based_res)
-        for i in content_based_res:
-            if i not in final_res:
-                final_res.append(i)
-        for i in col_fil_res:
-            if i not in final_res:
-                final_res.append(i)
-       
-    if len(final_res) is 0:
-        while(len(final_res) < 3):
-            option = random.randint(0, len(items) -1)
-            if option not in final_res:
-                final_res.append(str(option))
-    testx = final_res
-
-    JsonOut = json.dumps(final_res)
-    print(JsonOut)
-    sys.stdout.flush()
\ No newline at end of file
+        JsonOut = json.dumps(final_res)
+        print(JsonOut)
+        sys.stdout.flush()
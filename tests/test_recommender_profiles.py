@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attractions4u-recommender')
+sys.path.insert(0, LAMBDA_DIR)
+for name in ('ES', 'ES_U', 'ES_K'):
+    os.environ.setdefault(name, 'http://localhost' if name == 'ES' else 'test')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function  # noqa: E402
+from ann_index import IVFIndex, build_index  # noqa: E402
+from cache_backend import HttpCacheBackend  # noqa: E402
+
+
+class FakeCache:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, keys):
+        if not len(keys):
+            raise AssertionError('get without keys')
+        return [self.values.get(k) for k in keys]
+
+    def set(self, keys, values, ttl, encoding='json'):
+        self.values.update(zip(keys, values))
+        return [True] * len(keys)
+
+
+class SearchByProfilesTest(unittest.TestCase):
+    def setUp(self):
+        index_dir = tempfile.mkdtemp()
+        ids = [f'a{i}' for i in range(50)]
+        build_index(np.random.default_rng(0).normal(size=(50, 8)), ids, index_dir, nlist=4)
+        self.index = IVFIndex(index_dir, nprobe=4)
+        self.cache = FakeCache()
+        patches = [
+            mock.patch.object(lambda_function, 'cache', self.cache),
+            mock.patch.object(lambda_function.ann_indexes, 'instance', return_value=[self.index]),
+            mock.patch.object(lambda_function, 'HISTORY_RETRIEVAL', 'profile'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def search(self, histories):
+        with mock.patch.object(lambda_function, 'query_history', side_effect=lambda usr: histories[usr]):
+            return lambda_function.search_by_histories(list(histories))
+
+    def test_users_without_history(self):
+        self.assertEqual(self.search({'new@x': [], 'other@x': []}), [set(), set()])
+        self.assertEqual(self.cache.values, {})
+
+    def test_mixed_batch(self):
+        history = [{'attractionId': 'a1', 'cnt': 2, 'lastVisit': 1_700_000_000 * 10 ** 9}]
+        res = self.search({'new@x': [], 'old@x': history})
+        self.assertEqual(res[0], set())
+        self.assertTrue(len(res[1]))
+        self.assertNotIn('a1', res[1])
+        self.assertIn(lambda_function.profile_cache_key('old@x'), self.cache.values)
+
+
+class HttpCacheBackendTest(unittest.TestCase):
+    def test_get_without_keys(self):
+        http = mock.Mock()
+        self.assertEqual(HttpCacheBackend(http, 'http://cache', {}).get([]), [])
+        http.request.assert_not_called()
+
+
+class RebuildLockTest(unittest.TestCase):
+    def test_lock_released_without_profile(self):
+        with mock.patch.object(lambda_function, 'query_table_by_username', return_value=[]), \
+                mock.patch.object(lambda_function, 'release_rebuild_locks') as release:
+            with self.assertRaises(IndexError):
+                lambda_function.rebuild_user_recommendations(['new@x'])
+        release.assert_called_once_with(['new@x'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('RECOMMENDER_MODEL_DIR', tempfile.mkdtemp())
+
+import recommender_example  # noqa: E402
+from recommender_example import RecommenderState, handle_request  # noqa: E402
+
+
+class RecommenderStateTest(unittest.TestCase):
+    def test_empty_catalogue(self):
+        state = RecommenderState()
+        self.assertEqual(handle_request(state, {'items': []}), {'ok': True, 'items': 0})
+        self.assertEqual(handle_request(state, {'items': [], 'usernames': ['a', 'b']}), {'a': [], 'b': []})
+        self.assertIsNone(state.content)
+        self.assertIsNone(state.cf)
+
+    def test_failed_update_keeps_previous_catalogue(self):
+        state = RecommenderState()
+        state.update([])
+        purchase_index, df_1 = state.purchase_index, state.df_1
+        items = [{'item_id': 1, 'description': 'museum', 'buyer': 'a'}]
+        with mock.patch.object(recommender_example, 'content_model', side_effect=ValueError('empty vocabulary')):
+            with self.assertRaises(ValueError):
+                state.update(items)
+        self.assertIs(state.purchase_index, purchase_index)
+        self.assertIs(state.df_1, df_1)
+        with self.assertRaises(KeyError):
+            # No item_id
+            state.update([{'description': 'x', 'buyer': 'b'}])
+        self.assertIs(state.df_1, df_1)
+
+
+if __name__ == '__main__':
+    unittest.main()
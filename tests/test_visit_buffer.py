@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+from botocore.exceptions import EndpointConnectionError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attractions4u-attraction-py'))
+
+import visits  # noqa: E402
+from visits import VisitBuffer  # noqa: E402
+
+
+class VisitBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = VisitBuffer(None, 'attractions', 'history', max_age=60)
+        self.buffer.add('u@x', 'a1', 1)
+        self.buffer.add('u@x', 'a1', 3)
+        self.buffer.add('v@x', 'a2', 2)
+
+    def test_failed_updates_are_requeued(self):
+        def fail_a1(dynamo, table_name, aid, n=1):
+            if aid == 'a1':
+                raise EndpointConnectionError(endpoint_url='http://dynamo')
+
+        history = mock.Mock(side_effect=EndpointConnectionError(endpoint_url='http://dynamo'))
+        with mock.patch.object(visits, 'increment_attraction_cnt', side_effect=fail_a1), \
+                mock.patch.object(visits, 'record_history_visit', history):
+            self.assertEqual(self.buffer.flush(), ['a2'])
+        self.assertEqual(self.buffer.pending_cnt('a1'), 2)
+        self.assertEqual(self.buffer.pending_cnt('a2'), 0)
+        self.assertEqual(self.buffer.pending, {('u@x', 'a1'): [2, 3], ('v@x', 'a2'): [1, 2]})
+
+        # Views added in the meantime are merged with the retried ones
+        self.buffer.add('u@x', 'a1', 5)
+        increment, history = mock.Mock(), mock.Mock()
+        with mock.patch.object(visits, 'increment_attraction_cnt', increment), \
+                mock.patch.object(visits, 'record_history_visit', history):
+            self.assertEqual(self.buffer.flush(), ['a1'])
+        increment.assert_called_once_with(None, 'attractions', 'a1', 3)
+        history.assert_any_call(None, 'history', 'u@x', 'a1', 5, 3)
+        history.assert_any_call(None, 'history', 'v@x', 'a2', 2, 1)
+        self.assertEqual(self.buffer.pending, {})
+
+    def test_flush_while_another_is_stuck(self):
+        buffer = VisitBuffer(None, 'attractions', 'history', max_age=60, max_size=4, max_pending=6)
+        buffer.add('u@x', 'a1', 1)
+        release, written = threading.Event(), []
+
+        def increment(dynamo, table_name, aid, n=1):
+            if aid == 'a1':
+                release.wait(5)
+            written.append((aid, n))
+
+        with mock.patch.object(visits, 'increment_attraction_cnt', side_effect=increment), \
+                mock.patch.object(visits, 'record_history_visit'):
+            stuck = threading.Thread(target=buffer.flush)
+            stuck.start()
+            for aid in ('a2', 'a3'):
+                buffer.add('u@x', aid, 2)
+            self.assertTrue(buffer.is_due())
+            self.assertFalse(buffer.is_full())
+            buffer.add('v@x', 'a3', 3)
+            buffer.add('v@x', 'a4', 3)
+            self.assertTrue(buffer.is_full())
+            self.assertEqual(sorted(buffer.flush()), ['a2', 'a3', 'a4'])
+            self.assertEqual(sorted(written), [('a2', 1), ('a3', 2), ('a4', 1)])
+            release.set()
+            stuck.join()
+        self.assertEqual(written[-1], ('a1', 1))
+        self.assertFalse(buffer.is_due())
+
+
+if __name__ == '__main__':
+    unittest.main()
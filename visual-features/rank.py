@@ -1,26 +1,63 @@
-import cv2
+import argparse
 import numpy as np
 import os
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from featurelib.incremental import (  # noqa: E402
+    apply_update, content_hash, diff_manifest, load_manifest, load_neighbours, save_manifest,
+    update_neighbours, write_neighbours
+)
+from featurelib.topk import normalize, top_k  # noqa: E402
 
-img_paths = sorted(os.listdir('imgs'))
-
-vecs1 = np.load('densenet161_vecs.npy')
-vecs2 = np.load('resnet50_vecs.npy')
-vecs = np.concatenate((vecs2, vecs1), axis=1)  # ensemble
-vecs /= np.sqrt(np.power(vecs, 2).sum(-1))[..., np.newaxis]  # normalize
-similarity = vecs @ vecs.T  # cosine similarity
 
 k = 20
-# 1:k+1 below because the first one is the original image itself
-all_top = np.argsort(-similarity)[:, 1:k+1]
+SIMILARITY_FILE = 'visual_similar.txt'
+DELTA_FILE = 'visual_similar_delta.txt'
+MANIFEST_FILE = 'visual_similar_manifest.json'
 
 
 def get_aid(img_path):
     return img_path.split('.')[0]
 
 
-with open('visual_similar.txt', 'w+') as fi:
-    for img_path, top_ids in zip(img_paths, all_top):
-        fi.write(f"{get_aid(img_path)}:{','.join([get_aid(img_paths[i]) for i in top_ids])}\n")
-
+def load_vecs():
+    vecs1 = np.load('densenet161_vecs.npy')
+    vecs2 = np.load('resnet50_vecs.npy')
+    vecs = np.concatenate((vecs2, vecs1), axis=1).astype(np.float32)  # ensemble
+    return normalize(vecs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true',
+                        help='only update the lists affected by new, changed or removed vectors')
+    parser.add_argument('--workers', type=int, default=1, help='processes computing blocks of rows')
+    parser.add_argument('--block-rows', type=int, default=1024, help='rows scored against the catalogue at once')
+    args = parser.parse_args()
+
+    img_paths = sorted(os.listdir('imgs'))
+    ids = [get_aid(p) for p in img_paths]
+    vecs = load_vecs()
+
+    # Changed attractions are the ones whose ensemble vector changed since the last run
+    manifest = {aid: content_hash(vec.tobytes()) for aid, vec in zip(ids, vecs)}
+    old_lists = load_neighbours(SIMILARITY_FILE)
+    if args.incremental and len(old_lists):
+        changed, removed = diff_manifest(load_manifest(MANIFEST_FILE), manifest)
+        updates = update_neighbours(ids, vecs, old_lists, changed, removed, k)
+        write_neighbours(DELTA_FILE, updates)
+        write_neighbours(SIMILARITY_FILE, apply_update(ids, old_lists, updates), ids)
+        print(f'{len(changed)} new or changed, {len(removed)} removed, {len(updates)} lists updated')
+    else:
+        # Cosine similarity, the image itself is excluded
+        all_top, _ = top_k(vecs, k, block_rows=args.block_rows, workers=args.workers)
+
+        with open(SIMILARITY_FILE, 'w+') as fi:
+            for img_path, top_ids in zip(img_paths, all_top):
+                fi.write(f"{get_aid(img_path)}:{','.join([get_aid(img_paths[i]) for i in top_ids])}\n")
+    save_manifest(MANIFEST_FILE, manifest)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,133 @@
+import argparse
+import json
 import numpy as np
 import os
+import sys
 from PIL import Image
 import torch
 import torch.nn as nn
 import torchvision.models as models
 import torchvision.transforms as transforms
-from tqdm import trange
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from featurelib.incremental import diff_manifest, file_hash, load_manifest, save_manifest  # noqa: E402
 
-arch = 'resnet50'
-save_pt_path = '%s_places365.pt' % arch
-img_path = "12.jpg"
-device = torch.device("cuda:0") if torch.cuda.is_available() else ("cpu")
-model = models.__dict__[arch](num_classes=365, pretrained=False)
-model.load_state_dict(torch.load(save_pt_path))
-
-# We only need the feature vectors
-model.fc = nn.Identity()
-model.classifier = nn.Identity()
 
-model.to(device)
-model.eval()
+device = torch.device("cuda:0") if torch.cuda.is_available() else ("cpu")
 
+# Fixed-size input so that images can be batched. Stored in the manifests, changing it re-extracts every image.
+PREPROCESS = 'resize256-crop224'
 normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225])
 my_transforms = transforms.Compose([
     transforms.Resize(256),
+    transforms.CenterCrop(224),
     transforms.ToTensor(),
     normalize,
 ])
 
 
-def get_vec(img_path):
-    img = Image.open(img_path).convert('RGB')
-    tensor = my_transforms(img).to(device).unsqueeze(0)
-    with torch.no_grad():
-        outputs = model.forward(tensor)
-    # outputs = nn.functional.normalize(outputs, dim=1)
-    return outputs.squeeze(0).cpu().numpy()
+def load_model(arch):
+    save_pt_path = '%s_places365.pt' % arch
+    model = models.__dict__[arch](num_classes=365, pretrained=False)
+    model.load_state_dict(torch.load(save_pt_path, map_location='cpu'))
+
+    # We only need the feature vectors
+    model.fc = nn.Identity()
+    model.classifier = nn.Identity()
+
+    model.to(device)
+    model.eval()
+    return model
+
+
+class ImageDataset(Dataset):
+    # Decoding and preprocessing run in the DataLoader workers
+    def __init__(self, paths, rows):
+        self.paths = paths
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        img = Image.open(self.paths[i]).convert('RGB')
+        return self.rows[i], my_transforms(img)
+
+
+def get_aid(img_path):
+    return img_path.split('.')[0]
+
+
+def load_previous_vecs(arch, manifest):
+    # Vectors of the images that didn't change since the last run, by attraction ID
+    vecs_path, ids_path, manifest_path = f'{arch}_vecs.npy', f'{arch}_ids.json', f'{arch}_manifest.json'
+    if not (os.path.exists(vecs_path) and os.path.exists(ids_path)):
+        return {}
+    changed, _ = diff_manifest(load_manifest(manifest_path), manifest)
+    changed = set(changed)
+    with open(ids_path) as f:
+        old_ids = json.load(f)
+    old_vecs = np.load(vecs_path, mmap_mode='r')
+    return {aid: np.array(vec) for aid, vec in zip(old_ids, old_vecs) if aid not in changed}
+
+
+def output_dim(model):
+    with torch.inference_mode():
+        return model(torch.zeros(1, 3, 224, 224, device=device)).shape[1]
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true', help='only extract vectors of new or changed images')
+    parser.add_argument('--archs', nargs='+', default=['resnet50'],
+                        help='backbones run on every batch, each writes its own <arch>_vecs.npy')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4, help='image decoding processes')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
     img_paths = sorted(os.listdir('imgs'))
-    vecs = []
-    for i in trange(len(img_paths)):
-        img_path = os.path.join('imgs', img_paths[i])
-        vecs.append(get_vec(img_path))
-    vecs = np.stack(vecs, axis=0)
-    print(vecs.shape)
-    np.save(f'{arch}_vecs.npy', vecs)
+    ids = [get_aid(p) for p in img_paths]
+    manifest = {aid: f'{PREPROCESS}:{file_hash(os.path.join("imgs", p))}' for aid, p in zip(ids, img_paths)}
+    known = {arch: load_previous_vecs(arch, manifest) if args.incremental else {} for arch in args.archs}
+    # An image is extracted again by every backbone if any of them lacks its vector
+    todo = [i for i, aid in enumerate(ids) if any(aid not in known[arch] for arch in args.archs)]
+    print(f'{len(ids) - len(todo)} unchanged, {len(todo)} to extract')
+
+    nets = {arch: load_model(arch) for arch in args.archs}
+    # Streamed to memory-mapped files next to the old ones, which are replaced at the end
+    outs = {}
+    for arch, model in nets.items():
+        out = np.lib.format.open_memmap(f'{arch}_vecs.npy.tmp', mode='w+', dtype=np.float32,
+                                        shape=(len(ids), output_dim(model)))
+        for row, aid in enumerate(ids):
+            if aid in known[arch]:
+                out[row] = known[arch][aid]
+        outs[arch] = out
+
+    dataset = ImageDataset([os.path.join('imgs', img_paths[i]) for i in todo], todo)
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers,
+                        pin_memory=device != 'cpu')
+    with torch.inference_mode():
+        for rows, tensors in tqdm(loader):
+            tensors = tensors.to(device)
+            rows = rows.numpy()
+            for arch, model in nets.items():
+                # outputs = nn.functional.normalize(outputs, dim=1)
+                outs[arch][rows] = model(tensors).float().cpu().numpy()
+
+    for arch, out in outs.items():
+        out.flush()
+        print(arch, out.shape)
+        os.replace(f'{arch}_vecs.npy.tmp', f'{arch}_vecs.npy')
+        with open(f'{arch}_ids.json', 'w') as f:
+            json.dump(ids, f)
+        save_manifest(f'{arch}_manifest.json', manifest)
 
 
 if __name__ == '__main__':